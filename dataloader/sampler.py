@@ -0,0 +1,130 @@
+import os
+import torch
+import numpy as np
+import scipy.sparse as sp
+
+
+class NegativeSampler(object):
+    # fills the -1 slots of a bsize * (1 + ns) relation array in one shot; column 0 holds the gold relation
+
+    def __init__(self,n_relations):
+        self.n_relations = n_relations
+        self.rng = None
+        self.pid = None
+
+    def get_rng(self):
+        # one generator per worker process, seeded from torch's per-worker seed so runs are reproducible
+        pid = os.getpid()
+        if self.rng is None or self.pid != pid:
+            self.rng = np.random.default_rng(torch.initial_seed() % 2**32)
+            self.pid = pid
+        return self.rng
+
+    def uniform(self,rng,size):
+        return rng.integers(1,self.n_relations,size=size)
+
+    def draw(self,rng,positives):
+        return self.uniform(rng,len(positives))
+
+    def sample(self,relations):
+        rng = self.get_rng()
+        free = relations < 0
+        positives = relations[:,0]
+        todo = free
+        first = True
+        while todo.any():
+            rows,cols = np.nonzero(todo)
+            # strategy-specific draw first, uniform redraws for collisions so the loop always terminates
+            relations[rows,cols] = self.draw(rng,positives[rows]) if first else self.uniform(rng,len(rows))
+            first = False
+            same = relations[:,:,None] == relations[:,None,:]
+            earlier = np.tril(np.ones(same.shape[1:],dtype=bool),k=-1)
+            duplicate = (same & earlier).any(axis=2)
+            todo = free & (duplicate | (relations == 0))
+        return relations
+
+
+class UniformNegativeSampler(NegativeSampler):
+    pass
+
+
+class FrequencyNegativeSampler(NegativeSampler):
+    # relations are drawn proportionally to (count + 1) ** power of their gold frequency in training
+
+    def __init__(self,n_relations,counts,power=0.75):
+        super(FrequencyNegativeSampler, self).__init__(n_relations)
+        probs = (np.asarray(counts,dtype=np.float64) + 1) ** power
+        probs[0] = 0
+        self.probs = probs / probs.sum()
+
+    def draw(self,rng,positives):
+        return rng.choice(self.n_relations,size=len(positives),p=self.probs)
+
+
+class HardNegativeSampler(NegativeSampler):
+    # negatives are neighbours of the gold relation in the relation adjacency matrix,
+    # uniform for relations without neighbours
+
+    def __init__(self,n_relations,adj_matrix):
+        super(HardNegativeSampler, self).__init__(n_relations)
+        adj_matrix = sp.csr_matrix(adj_matrix)
+        adj_matrix = (adj_matrix - sp.diags(adj_matrix.diagonal())).tocsr()
+        adj_matrix.eliminate_zeros()
+        self.indptr = adj_matrix.indptr
+        self.indices = adj_matrix.indices
+
+    def draw(self,rng,positives):
+        start = self.indptr[positives]
+        degree = self.indptr[positives + 1] - start
+        offset = (rng.random(len(positives)) * degree).astype(np.int64)
+        has_neighbour = degree > 0
+        draws = self.uniform(rng,len(positives))
+        draws[has_neighbour] = self.indices[(start + offset)[has_neighbour]]
+        return draws
+
+
+def build_negative_sampler(strategy,n_relations,label_dict=None,adj_matrix=None):
+    if strategy == 'uniform':
+        return UniformNegativeSampler(n_relations)
+    elif strategy == 'frequency':
+        counts = np.zeros(n_relations)
+        for label,idxs in label_dict.items():
+            counts[label] = len(idxs)
+        return FrequencyNegativeSampler(n_relations,counts)
+    elif strategy == 'hard':
+        return HardNegativeSampler(n_relations,adj_matrix)
+    raise ValueError('Unknown negative sampling strategy: {}'.format(strategy))
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    # batches of similar-length questions: indices are shuffled, sorted by length inside windows of
+    # batch_size * bucket_size_multiplier, cut into batches, and the batch order is shuffled again
+
+    def __init__(self,lengths,batch_size,shuffle=True,bucket_size_multiplier=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths)).numpy()
+        else:
+            order = np.arange(len(self.lengths))
+        batches = []
+        for start in range(0,len(order),self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket],kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0,len(bucket),self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter([batch.tolist() for batch in batches])
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def get_lengths(dataset):
+    if isinstance(dataset,torch.utils.data.Subset):
+        return get_lengths(dataset.dataset)[np.asarray(dataset.indices)]
+    return dataset.lengths
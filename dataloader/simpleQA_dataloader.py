@@ -3,13 +3,18 @@ from torch.utils.data import Dataset
 from collections import defaultdict
 import linecache
 import os
-import dill
 import numpy as np
 import random
+import json
+import time
+from array import array
+import scipy.sparse as sp
 
 
-from utils.util import pad,load_pretrained
-from dataloader.vocab import SimpleQAVocab
+from utils.util import pad_array,load_pretrained,vocab_fingerprint
+from dataloader.vocab import SimpleQAVocab,load_vocab,save_vocab
+from dataloader.sampler import build_negative_sampler
+from utils.graph_util import save_adj_matrix,load_adj_matrix
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -36,6 +41,7 @@ class SimpleQADataset(Dataset):
         self.filename = filename
         self.batch_size = batch_size
         self.ns = ns
+        self.negative_sampler = None
 
     def read_file(self,filename):
 
@@ -43,13 +49,16 @@ class SimpleQADataset(Dataset):
         self.label_set = set()
         cnt = 0
         self.length = 0
+        lengths = []
         with open(filename,'r') as f:
             for line in f:
                 gold,neg,question = line.rstrip().split('\t')
                 self.label_dict[int(gold)].append(cnt)
                 self.label_set.add(int(gold))
+                lengths.append(len(question.split()))
                 cnt += 1
                 self.length += 1
+        self.lengths = np.array(lengths,dtype=np.int64)
 
     def process_line(self,line):
         gold,neg,question = line.rstrip().split('\t')
@@ -90,28 +99,37 @@ class SimpleQADataset(Dataset):
     def get_raw_instance(self,idx):
         return linecache.getline(self.filename,idx+1)
 
-    def __getitem__(self,item):
+    def get_instance(self,item):
         line = linecache.getline(self.filename,item + 1)
-        instance = self.process_line(line)
+        return self.process_line(line)
+
+    def __getitem__(self,item):
+        instance = self.get_instance(item)
         pos = instance['relations'][0]
         if self.ns > 0:
+            if self.negative_sampler is not None:
+                # negatives are drawn per batch by NegativeSamplingCollator
+                return instance
             while len(instance['relations']) - 1 < self.ns:
                 idx = random.randint(1,len(self.vocab.rtoi) - 1)
                 if idx in instance['relations']:
                     continue
                 instance['relations'].append(idx)
-        else:
-            while len(instance['relations']) - 1 < 200:
-                instance['relations'].append(0)
+        # evaluation candidates are padded with 0 to the batch maximum in collate_fn
         return instance
 
     @staticmethod
     def build_vocab(filenames,args):
+        return SimpleQAVocab.build(filenames,args.relation_file,args.min_freq,args.max_vocab_size,args.vocab_workers)
+
+    @staticmethod
+    def build_vocab_loop(filenames,relation_file):
+        # reference single-pass builder, kept for benchmarking SimpleQAVocab.build
         vocab = SimpleQAVocab()
         vocab.stoi = {'<pad>':0,'<unk>':1,'<relpad>':2}
         vocab.rtoi = {}
         vocab.itor = {}
-        with open(args.relation_file,'r') as f:
+        with open(relation_file,'r') as f:
             for line in f.readlines():
                 relation = line.rstrip()
                 if relation not in vocab.rtoi:
@@ -137,79 +155,210 @@ class SimpleQADataset(Dataset):
             filepaths[i] = os.path.join(args.data_dir,filepaths[i])
 
         vocab = SimpleQADataset.build_vocab(filepaths,args)
-        torch.save(vocab,args.vocab_pth)
+        save_vocab(vocab,args.vocab_pth)
 
         print('Saved Vocab')
 
     @staticmethod
     def generate_embedding(args,device):
-        vocab = torch.load(args.vocab_pth)
-        args.word_pretrained = load_pretrained(args.glove_pth,vocab.stoi,dim=args.word_dim,device=device,pad_idx=args.padding_idx)
+        vocab = load_vocab(args.vocab_pth)
+        args.word_pretrained = load_pretrained(args.glove_pth,vocab.stoi,dim=args.word_dim,device=device,pad_idx=args.padding_idx,workers=args.embedding_workers)
         torch.save(args.word_pretrained,args.word_pretrained_pth)
 
     @staticmethod
     def generate_relation_embedding(args,device):
-        vocab = torch.load(args.vocab_pth)
-        vecs = np.random.normal(0,1,(len(vocab.rtoi),50))
-        vecs[args.padding_idx] = np.zeros((50))
-        cnt = 0
-        with open(args.relation_vec_pth,'r') as f:
-            for line in f:
-                splited = line.split('\t')
-                word = splited[0]
-                vec = splited[1]
-                if word not in vocab.rtoi:
-                    continue
-                cnt += 1
-                vec = [float(f) for f in vec.split()]
-                vecs[vocab.rtoi[word]] = vec
-            print('Found word vectors: {}/{}'.format(cnt,len(vocab.rtoi)))
-        relation_pretrained = torch.from_numpy(vecs).float().to(device)
+        vocab = load_vocab(args.vocab_pth)
+        relation_pretrained = load_pretrained(args.relation_vec_pth,vocab.rtoi,dim=50,device=device,pad_idx=args.padding_idx,sep='\t',skip_header=False,workers=args.embedding_workers)
         torch.save(relation_pretrained,args.relation_pretrained_pth)
 
     @staticmethod
     def generate_graph(args,device):
-        vocab = torch.load(args.vocab_pth)
+        vocab = load_vocab(args.vocab_pth)
         print('Total Relations: {}'.format(len(vocab.rtoi)))
         relation_pretrained = torch.load(args.relation_pretrained_pth)
-        distance_matrix = pairwise_distances(relation_pretrained)
-        print(distance_matrix.mean())
-        adj_matrix = (distance_matrix < args.threshold).long().cpu().numpy()
-        print(adj_matrix.sum())
+        if args.graph_mode == 'dense':
+            distance_matrix = pairwise_distances(relation_pretrained)
+            print(distance_matrix.mean())
+            adj_matrix = (distance_matrix < args.threshold).long().cpu().numpy()
+            print(adj_matrix.sum())
+            torch.save(adj_matrix,args.relation_adj_matrix_pth)
+        else:
+            adj_matrix = SimpleQADataset.generate_sparse_graph(relation_pretrained,args.graph_mode,args.threshold,args.knn,args.block_size)
+            print(adj_matrix.nnz)
+            save_adj_matrix(adj_matrix,args.relation_adj_matrix_pth)
 
-        torch.save(adj_matrix,args.relation_adj_matrix_pth)
+    @staticmethod
+    def generate_sparse_graph(relation_pretrained,mode,threshold,k,block_size):
+        # distances are computed for block_size rows at a time, so peak memory is block_size * N
+        num_nodes = relation_pretrained.size(0)
+        rows,cols = [],[]
+        for start in range(0,num_nodes,block_size):
+            end = min(start + block_size,num_nodes)
+            distance_block = pairwise_distances(relation_pretrained[start:end],relation_pretrained)
+            if mode == 'threshold':
+                block_rows,block_cols = (distance_block < threshold).nonzero(as_tuple=True)
+            elif mode == 'knn':
+                # k nearest neighbours of each relation, excluding itself
+                distance_block[torch.arange(end - start),torch.arange(start,end)] = float('inf')
+                block_cols = distance_block.topk(k=min(k,num_nodes - 1),dim=1,largest=False)[1].reshape(-1)
+                block_rows = torch.arange(end - start,device=block_cols.device).repeat_interleave(min(k,num_nodes - 1))
+            else:
+                raise ValueError('Unknown graph mode: {}'.format(mode))
+            rows.append((block_rows + start).cpu().numpy())
+            cols.append(block_cols.cpu().numpy())
+            print('\r{}/{}'.format(end,num_nodes),end='')
+        print()
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        data = np.ones(len(rows),dtype=np.int64)
+        return sp.csr_matrix((data,(rows,cols)),shape=(num_nodes,num_nodes))
 
     @staticmethod
     def collate_fn(list_of_examples):
-        question = np.array(pad([x['question'] for x in list_of_examples],0))
+        question = pad_array([x['question'] for x in list_of_examples],0)
 
-        relation = [x['relations'] for x in list_of_examples]
+        relation = pad_array([x['relations'] for x in list_of_examples],0)
 
-        labels = [0] * len(relation)
+        labels = np.zeros(len(relation),dtype=np.int64)
 
         return {
             'question':question,
-            'relation':np.array(relation),
-            'labels':np.array(labels),
+            'relation':relation,
+            'labels':labels,
         }
 
     @staticmethod
     def load_dataset(fnames,vocab_pth,args):
-        vocab = torch.load(vocab_pth,pickle_module=dill)
+        vocab = load_vocab(vocab_pth)
 
+        dataset_cls = SimpleQABinaryDataset if args.binary_data else SimpleQADataset
         datasets = []
         for i,fname in enumerate(fnames):
             if i == 0:
-                datasets.append(SimpleQADataset(fname,vocab,args.batch_size,args.ns))
+                dataset = dataset_cls(fname,vocab,args.batch_size,args.ns)
+                if args.ns > 0:
+                    adj_matrix = None
+                    if args.negative_sampling == 'hard':
+                        adj_matrix = args.adj_matrix[0] if args.use_gcn else load_adj_matrix(args.relation_adj_matrix_pth[0])
+                    dataset.negative_sampler = build_negative_sampler(args.negative_sampling,len(vocab.rtoi),dataset.label_dict,adj_matrix)
+                datasets.append(dataset)
             else:
-                datasets.append(SimpleQADataset(fname,vocab,args.batch_size,ns=0))
+                datasets.append(dataset_cls(fname,vocab,args.batch_size,ns=0))
 
         return tuple(datasets)
 
     @staticmethod
     def load_vocab(args):
-        return torch.load(args.vocab_pth)
+        return load_vocab(args.vocab_pth)
 
     @staticmethod
     def load_graph(args):
         return torch.load(args.graph_pth)
+
+
+class NegativeSamplingCollator(object):
+    # training collate_fn that draws all negatives of a batch at once
+
+    def __init__(self,sampler,ns):
+        self.sampler = sampler
+        self.ns = ns
+
+    def __call__(self,list_of_examples):
+        relations = [x['relations'] for x in list_of_examples]
+        width = max(1 + self.ns,max(len(r) for r in relations))
+        relation = self.sampler.sample(pad_array(relations,-1,max_len=width))
+        return {
+            'question':pad_array([x['question'] for x in list_of_examples],0),
+            'relation':relation,
+            'labels':np.zeros(len(relation),dtype=np.int64),
+        }
+
+
+class SimpleQABinaryDataset(SimpleQADataset):
+    # pre-tokenized form of a TSV file: int32 token / relation arrays with int64 offsets,
+    # opened with mmap so DataLoader workers share the pages instead of each parsing the file
+
+    def __init__(self,filename,vocab,batch_size,ns=0,train=True):
+        self.vocab = vocab
+        self.filename = filename
+        self.batch_size = batch_size
+        self.ns = ns
+        self.negative_sampler = None
+        prefix = filename + '.bin'
+        if not SimpleQABinaryDataset.is_valid(filename,prefix,vocab):
+            SimpleQABinaryDataset.convert(filename,prefix,vocab)
+        self.tokens = np.load(prefix + '.tokens.npy',mmap_mode='r')
+        self.token_offsets = np.load(prefix + '.token_offsets.npy',mmap_mode='r')
+        self.relations = np.load(prefix + '.relations.npy',mmap_mode='r')
+        self.relation_offsets = np.load(prefix + '.relation_offsets.npy',mmap_mode='r')
+        self.build_label_dict()
+
+    def build_label_dict(self):
+        self.length = len(self.relation_offsets) - 1
+        self.lengths = np.diff(np.asarray(self.token_offsets))
+        gold = np.asarray(self.relations[self.relation_offsets[:-1]])
+        self.label_dict = defaultdict(lambda: [])
+        order = np.argsort(gold,kind='stable')
+        labels,starts = np.unique(gold[order],return_index=True)
+        for label,idxs in zip(labels.tolist(),np.split(order,starts[1:])):
+            self.label_dict[label] = idxs.tolist()
+        self.label_set = set(labels.tolist())
+
+    @staticmethod
+    def source_meta(filename,vocab):
+        stat = os.stat(filename)
+        # the vocab fingerprint catches rebuilt vocabs with the same size but different ids
+        return {'size':stat.st_size,'mtime':stat.st_mtime,'n_words':len(vocab.stoi),'vocab':vocab_fingerprint(vocab.stoi)}
+
+    @staticmethod
+    def is_valid(filename,prefix,vocab):
+        if not os.path.exists(prefix + '.meta.json'):
+            return False
+        with open(prefix + '.meta.json','r') as f:
+            return json.load(f) == SimpleQABinaryDataset.source_meta(filename,vocab)
+
+    @staticmethod
+    def convert(filename,prefix,vocab):
+        tokens,token_offsets = array('i'),array('q',[0])
+        relations,relation_offsets = array('i'),array('q',[0])
+        with open(filename,'r') as f:
+            for line in f:
+                gold,neg,question = line.rstrip().split('\t')
+                tokens.extend(vocab.stoi.get(word,1) for word in question.split())
+                token_offsets.append(len(tokens))
+                relations.append(int(gold))
+                relations.extend(int(n) for n in neg.split() if n.lstrip('-').isdigit())
+                relation_offsets.append(len(relations))
+        np.save(prefix + '.tokens.npy',np.frombuffer(tokens,dtype=np.int32))
+        np.save(prefix + '.token_offsets.npy',np.frombuffer(token_offsets,dtype=np.int64))
+        np.save(prefix + '.relations.npy',np.frombuffer(relations,dtype=np.int32))
+        np.save(prefix + '.relation_offsets.npy',np.frombuffer(relation_offsets,dtype=np.int64))
+        with open(prefix + '.meta.json','w') as f:
+            json.dump(SimpleQABinaryDataset.source_meta(filename,vocab),f)
+        print('Converted {} ({} examples)'.format(filename,len(relation_offsets) - 1))
+
+    def get_instance(self,item):
+        return {
+            'question': self.tokens[self.token_offsets[item]:self.token_offsets[item + 1]],
+            'relations': self.relations[self.relation_offsets[item]:self.relation_offsets[item + 1]].tolist(),
+        }
+
+
+def benchmark_items(dataset,n_items=100000):
+    n_items = min(n_items,len(dataset))
+    start_time = time.time()
+    for i in range(n_items):
+        dataset[i]
+    elapsed = time.time() - start_time
+    return n_items / elapsed
+
+
+if __name__ == '__main__':
+    import sys
+    fname,vocab_pth = sys.argv[1],sys.argv[2]
+    vocab = load_vocab(vocab_pth)
+    for dataset_cls in [SimpleQADataset,SimpleQABinaryDataset]:
+        start_time = time.time()
+        dataset = dataset_cls(fname,vocab,32,ns=0)
+        load_time = time.time() - start_time
+        print('{}: opened in {:.2f}s, {:.0f} items/sec'.format(dataset_cls.__name__,load_time,benchmark_items(dataset)))
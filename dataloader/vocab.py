@@ -1,5 +1,11 @@
-from utils.util import pad
+import io
+import os
+import json
+import time
 import numpy as np
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from utils.util import pad,chunk_offsets
 class Vocab(object):
     def __init__(self):
         pass
@@ -12,12 +18,104 @@ class Vocab(object):
                 getattr(self,name)[d] = len(getattr(self,name))
 
 
+def split_relation(relation):
+    return relation.replace('.',' ').replace('_',' ').split()
+
+
+def count_question_chunk(filepath,start,end):
+    # word counts of the question column of one line-aligned byte range
+    with open(filepath,'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).decode('utf-8')
+    # line breaks as text-mode iteration sees them (\n, \r\n, \r), unlike str.splitlines which also
+    # splits at \x0c, \x85, \u2028 and friends inside a question
+    lines = io.StringIO(data,newline=None)
+    return Counter(' '.join(line.split('\t',2)[2] for line in lines).split())
+
+
+def count_question_words(filenames,workers=1):
+    # chunk counters are merged in file order, so the merged Counter keeps first-occurrence order
+    ranges = []
+    for filepath in filenames:
+        offsets = chunk_offsets(filepath,max(workers,1) * 4)
+        ranges.extend((filepath,s,e) for s,e in zip(offsets[:-1],offsets[1:]))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(count_question_chunk,*zip(*ranges)))
+    else:
+        chunks = [count_question_chunk(*r) for r in ranges]
+    counter = Counter()
+    for chunk in chunks:
+        counter.update(chunk)
+    return counter
+
+
 class SimpleQAVocab(Vocab):
 
     def __init__(self):
         self.relIdx2wordIdx = {}
         self.relIdx2nameIdx = {}
 
+    @staticmethod
+    def build(filenames,relation_file,min_freq=1,max_size=None,workers=1):
+        # special tokens and relation words are always kept; question words below min_freq are dropped and
+        # max_size keeps the most frequent ones, ids otherwise follow first occurrence as in the legacy builder
+        vocab = SimpleQAVocab()
+        vocab.stoi = {'<pad>':0,'<unk>':1,'<relpad>':2}
+        vocab.rtoi = {}
+        vocab.itor = {}
+        with open(relation_file,'r') as f:
+            for line in f:
+                relation = line.rstrip()
+                if relation not in vocab.rtoi:
+                    vocab.itor[len(vocab.rtoi)] = relation
+                    vocab.rtoi[relation] = len(vocab.rtoi)
+                for word in split_relation(relation):
+                    vocab.stoi.setdefault(word,len(vocab.stoi))
+
+        counter = count_question_words(filenames,workers)
+        words = [w for w,c in counter.items() if c >= min_freq and w not in vocab.stoi]
+        if max_size is not None and len(vocab.stoi) + len(words) > max_size:
+            keep = set(sorted(words,key=lambda w: -counter[w])[:max(0,max_size - len(vocab.stoi))])
+            words = [w for w in words if w in keep]
+        for word in words:
+            vocab.stoi[word] = len(vocab.stoi)
+        print('Vocab: {} words ({} distinct in questions, min_freq={}, max_size={})'.format(len(vocab.stoi),len(counter),min_freq,max_size))
+
+        for rel,idx in vocab.rtoi.items():
+            vocab.relIdx2wordIdx[idx] = [vocab.stoi[w] for w in split_relation(rel)]
+        vocab.counts = counter
+        return vocab
+
+    def save(self,pth):
+        # word and relation strings as JSON, relation word ids as flat arrays in a sidecar .npz
+        prefix = os.path.splitext(pth)[0]
+        itos = [w for w,_ in sorted(self.stoi.items(),key=lambda x: x[1])]
+        itor = [self.itor[i] for i in range(len(self.itor))]
+        relation_words = [self.relIdx2wordIdx[i] for i in range(len(itor))]
+        offsets = np.cumsum([0] + [len(words) for words in relation_words])
+        with open(prefix + '.json','w') as f:
+            json.dump({'itos':itos,'itor':itor},f)
+        np.savez(prefix + '.npz',
+                 relation_words=np.array([w for words in relation_words for w in words],dtype=np.int64),
+                 relation_word_offsets=offsets.astype(np.int64),
+                 word_counts=np.array([getattr(self,'counts',{}).get(w,0) for w in itos],dtype=np.int64))
+
+    @staticmethod
+    def load(pth):
+        prefix = os.path.splitext(pth)[0]
+        with open(prefix + '.json','r') as f:
+            data = json.load(f)
+        arrays = np.load(prefix + '.npz')
+        vocab = SimpleQAVocab()
+        vocab.stoi = dict(zip(data['itos'],range(len(data['itos']))))
+        vocab.itor = dict(enumerate(data['itor']))
+        vocab.rtoi = dict(zip(data['itor'],range(len(data['itor']))))
+        relation_words = arrays['relation_words'].tolist()
+        offsets = arrays['relation_word_offsets'].tolist()
+        vocab.relIdx2wordIdx = dict((i,relation_words[offsets[i]:offsets[i + 1]]) for i in range(len(data['itor'])))
+        return vocab
+
     def get_all_relation_words(self):
         n_relations = len(self.rtoi)
         max_len = 0
@@ -29,3 +127,41 @@ class SimpleQAVocab(Vocab):
     def get_all_relation_names(self):
         n_relations = len(self.rtoi)
         return np.array(pad([self.relIdx2nameIdx[i] for i in range(n_relations)],0,max_len=10))
+
+
+def save_vocab(vocab,pth):
+    # .json paths use the compact format, anything else the legacy torch pickle
+    if pth.endswith('.json'):
+        vocab.save(pth)
+    else:
+        import torch
+        torch.save(vocab,pth)
+
+
+def load_vocab(pth):
+    if pth.endswith('.json'):
+        return SimpleQAVocab.load(pth)
+    import torch
+    import dill
+    return torch.load(pth,pickle_module=dill)
+
+
+def benchmark_vocab(filenames,relation_file,workers=4,pth='/tmp/vocab.json'):
+    from dataloader.simpleQA_dataloader import SimpleQADataset
+    start_time = time.time()
+    legacy = SimpleQADataset.build_vocab_loop(filenames,relation_file)
+    legacy_time = time.time() - start_time
+    for n in [1,workers]:
+        start_time = time.time()
+        vocab = SimpleQAVocab.build(filenames,relation_file,workers=n)
+        print('build with {} workers: {:.2f}s (legacy {:.2f}s), identical ids: {}'.format(n,time.time() - start_time,legacy_time,vocab.stoi == legacy.stoi))
+    for path in [pth,os.path.splitext(pth)[0] + '.pt']:
+        save_vocab(vocab,path)
+        start_time = time.time()
+        load_vocab(path)
+        print('load {}: {:.3f}s'.format(path,time.time() - start_time))
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark_vocab(sys.argv[2:],sys.argv[1])
@@ -13,9 +13,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+import time
 
 from overrides import overrides
-import dgl.function as fn
+from utils.graph_util import SparseGraph
 
 
 class RGCNLayer(nn.Module):
@@ -65,6 +66,27 @@ class RGCNLayer(nn.Module):
 
         g.ndata['h'] = node_repr
 
+    # sparse backend: same computation on an explicit feature tensor and a normalized (n_dst x n_src)
+    # sparse matrix; the first n_dst rows of h belong to the destination nodes
+    def propagate_sparse(self, adj, h):
+        raise NotImplementedError
+
+    def forward_sparse(self, adj, h):
+        if self.self_loop:
+            loop_message = torch.mm(h[:adj.size(0)], self.loop_weight)
+            if self.dropout is not None:
+                loop_message = self.dropout(loop_message)
+
+        node_repr = self.propagate_sparse(adj, h)
+
+        if self.bias:
+            node_repr = node_repr + self.bias
+        if self.self_loop:
+            node_repr = node_repr + loop_message
+        if self.activation:
+            node_repr = self.activation(node_repr)
+        return node_repr
+
 
 class RGCNTransLayer(RGCNLayer):
     @overrides
@@ -84,17 +106,25 @@ class RGCNTransLayer(RGCNLayer):
         return {'msg':edges.src['h'] * edges.src['norm']}
 
     def propagate(self,g):
+        import dgl.function as fn
         g.update_all(self.msg_func,fn.sum(msg='msg',out='h'),self.apply_func)
 
+    def transform(self,data):
+        if self.activation is not None:
+            return self.activation(self.linear(self.dropout(data)))
+        else:
+            return self.linear(data)
+
     def apply_func(self,nodes):
         if self.norm_type == 'gcn':
             data = nodes.data['h'] * nodes.data['norm']
         else:
             data = nodes.data['h']
-        if self.activation is not None:
-            return {'h': self.activation(self.linear(self.dropout(data)))}
-        else:
-            return {'h': self.linear(data)}
+        return {'h': self.transform(data)}
+
+    def propagate_sparse(self,adj,h):
+        # both norms are already in the edge values of adj
+        return self.transform(torch.sparse.mm(adj,h))
 
 
 class BaseRGCN(nn.Module):
@@ -148,10 +178,30 @@ class BaseRGCN(nn.Module):
     def forward(self):
         if self.features is not None:
             self.g.ndata['id'] = self.features
+        if isinstance(self.g,SparseGraph):
+            h = self.layers[0].forward_sparse(self.g,None)
+            for layer in self.layers[1:]:
+                h = layer.forward_sparse(self.g.adj,h)
+            return h
         for layer in self.layers:
             layer(self.g)
         return self.g.ndata.pop('h')
 
+    def forward_nodes(self, nodes, fanout=0):
+        # representations of `nodes` only: the k-hop in-neighbourhood is expanded layer by layer
+        # (optionally sampled down to `fanout` neighbours per node) and only those rows are propagated
+        if not isinstance(self.g,SparseGraph):
+            return self.forward()[nodes]
+        dst = nodes.cpu().numpy()
+        blocks = []
+        for _ in self.layers[1:]:
+            block,dst = self.g.sample_block(dst,fanout)
+            blocks.append(block.to(nodes.device))
+        h = self.layers[0].embedding(torch.from_numpy(dst).to(nodes.device))
+        for layer,block in zip(self.layers[1:],reversed(blocks)):
+            h = layer.forward_sparse(block,h)
+        return h
+
 
 class EmbeddingLayer(nn.Module):
     def __init__(self, num_nodes, h_dim,pretrained=None):
@@ -165,6 +215,9 @@ class EmbeddingLayer(nn.Module):
         node_id = g.ndata['id'].squeeze()
         g.ndata['h'] = self.embedding(node_id)
 
+    def forward_sparse(self, g, h):
+        return self.embedding(g.ndata['id'].squeeze())
+
 
 class RGCN(BaseRGCN):
     def build_input_layer(self):
@@ -173,3 +226,58 @@ class RGCN(BaseRGCN):
     def build_hidden_layer(self, idx):
         act = F.relu if idx < self.num_hidden_layers - 1 else None
         return RGCNTransLayer(in_feat=self.h_dim,out_feat=self.h_dim,activation=act,self_loop=False,dropout=self.dropout,norm_type=self.norm_type)
+
+
+def build_backend_pair(num_nodes,h_dim,num_hidden_layers,norm_type):
+    # the same random graph and weights on the DGL and the sparse backend
+    from utils.graph_util import random_adj_matrix,build_graph_from_adj_matrix,build_sparse_graph_from_adj_matrix
+    device = torch.device('cpu')
+    adj_matrix = random_adj_matrix(num_nodes,density=5e-3)
+    pretrained = torch.randn(num_nodes,h_dim)
+    dgl_graph = build_graph_from_adj_matrix(adj_matrix,device,norm_type)
+    sparse_graph = build_sparse_graph_from_adj_matrix(adj_matrix,device,norm_type)
+    dgl_model = RGCN(dgl_graph,num_nodes,h_dim,h_dim,pretrained,num_hidden_layers,0.,norm_type).eval()
+    sparse_model = RGCN(sparse_graph,num_nodes,h_dim,h_dim,pretrained,num_hidden_layers,0.,norm_type).eval()
+    sparse_model.load_state_dict(dgl_model.state_dict())
+    return dgl_model,sparse_model
+
+
+def check_sparse_backend(num_nodes=2000,h_dim=64,num_hidden_layers=2,atol=1e-5):
+    # numerical equivalence of the DGL and sparse backends, full graph and k-hop forward_nodes, for both norms
+    for norm_type in ['spectral','gcn']:
+        dgl_model,sparse_model = build_backend_pair(num_nodes,h_dim,num_hidden_layers,norm_type)
+        with torch.no_grad():
+            dgl_out = dgl_model()
+            sparse_out = sparse_model()
+            assert torch.allclose(dgl_out,sparse_out,atol=atol), \
+                '{}: sparse backend differs from DGL by {:.2e}'.format(norm_type,(dgl_out - sparse_out).abs().max().item())
+            nodes = torch.randperm(num_nodes)[:64]
+            node_out = sparse_model.forward_nodes(nodes)
+            assert torch.allclose(node_out,dgl_out[nodes],atol=atol), \
+                '{}: forward_nodes differs from the full forward by {:.2e}'.format(norm_type,(node_out - dgl_out[nodes]).abs().max().item())
+        print('{}: sparse backend and forward_nodes match DGL'.format(norm_type))
+
+
+def benchmark_sparse_backend(num_nodes=2000,h_dim=64,num_hidden_layers=2,norm_type='spectral',repeat=10):
+    # per-layer propagation time of both backends
+    dgl_model,sparse_model = build_backend_pair(num_nodes,h_dim,num_hidden_layers,norm_type)
+    dgl_graph,sparse_graph = dgl_model.g,sparse_model.g
+    with torch.no_grad():
+        h = sparse_model.layers[0].forward_sparse(sparse_graph,None)
+        for i,(dgl_layer,sparse_layer) in enumerate(zip(dgl_model.layers[1:],sparse_model.layers[1:])):
+            start_time = time.time()
+            for _ in range(repeat):
+                dgl_graph.ndata['h'] = h
+                dgl_layer(dgl_graph)
+            dgl_time = (time.time() - start_time) / repeat
+            start_time = time.time()
+            for _ in range(repeat):
+                out = sparse_layer.forward_sparse(sparse_graph.adj,h)
+            sparse_time = (time.time() - start_time) / repeat
+            print('layer {}: dgl {:.2f}ms, sparse {:.2f}ms'.format(i,dgl_time * 1000,sparse_time * 1000))
+            h = out
+
+
+if __name__ == '__main__':
+    check_sparse_backend()
+    benchmark_sparse_backend()
@@ -1,10 +1,16 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
+import time
+from torch.nn.utils.rnn import PackedSequence
+from torch.nn.utils.rnn import pack_padded_sequence as pack
 
 from utils.module import LSTMEncoder,mean_pool,max_pool,GateNetwork
-from utils.metric import micro_precision,macro_precision
+from utils.metric import MetricAccumulator,precision_breakdown
 from model.GCN import RGCN
+from utils.index import build_index,recall_at_k
+from utils.meter import TrainingMeter
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 global_step = 0
@@ -64,21 +70,68 @@ class SimpleQA(nn.Module):
         self.optimizer = torch.optim.Adam(self.parameters(),lr=args.lr)
 
         self.ns = args.ns
-        self.score_function = nn.CosineSimilarity(dim=2)
+        self.score_all = args.score_all
 
-        self.all_relation_words = args.all_relation_words
+        self.all_relation_words = np.asarray(args.all_relation_words)
+        self.register_relation_words(args)
+        self.relation_sampling = args.relation_sampling
+        self.rgcn_fanout = args.rgcn_fanout
 
         self.n_relations = args.n_relations
         self.args = args
+        self.relation_cache = None
+        self.relation_cache_frozen = False
+        self.index = None
 
         global global_step
         global_step = 0
 
-    def get_relation_embedding(self):
+    def register_relation_words(self,args):
+        # relation words never change, so they are turned into tensors, counted, sorted by length and
+        # packed once; non-persistent buffers follow .to(device) without entering the state dict
+        relation_words = torch.from_numpy(self.all_relation_words.astype(np.int64))
+        lengths = (relation_words != args.padding_idx).sum(dim=-1).clamp(min=1)
+        lengths,perm_idx = lengths.sort(0,descending=True)
+        packed = pack(relation_words[perm_idx],lengths,batch_first=True)
+        self.register_buffer('relation_words',relation_words,persistent=False)
+        self.register_buffer('relation_words_packed',packed.data,persistent=False)
+        self.register_buffer('relation_words_unperm',perm_idx.sort(0)[1],persistent=False)
+        # batch_sizes of a PackedSequence must stay on the CPU, so it is a plain attribute
+        self.relation_words_batch_sizes = packed.batch_sizes
+        # with frozen pretrained word vectors the packed embedding lookup is memoized as well
+        self.memoize_relation_words = args.word_pretrained is not None and args.freeze
+        self.relation_words_embedded = None
+
+    def embed_relation_words(self):
+        if not self.memoize_relation_words:
+            return self.word_embedding(self.relation_words_packed)
+        if self.relation_words_embedded is None or self.relation_words_embedded.device != self.relation_words_packed.device:
+            with torch.no_grad():
+                self.relation_words_embedded = self.word_embedding(self.relation_words_packed)
+        return self.relation_words_embedded
+
+    def encode_relation_words(self,relation_words=None):
+        # relation_words=None: the whole catalog through the pre-packed sequence, no per-step sort;
+        # otherwise a padded (n * max_len) subset, sorted inside the encoder
+        if relation_words is None:
+            packed = PackedSequence(self.embed_relation_words(),self.relation_words_batch_sizes)
+            return max_pool(self.word_encoder.forward_packed(packed,self.relation_words_unperm),None)
+        relation_words_lengths = (relation_words != self.args.padding_idx).sum(dim=-1).long()
+        relation_words = relation_words[:,:max(1,int(relation_words_lengths.max()))]
+        relation_words_mask = (relation_words != self.args.padding_idx)
+        relation_words_repre = self.word_embedding(relation_words)
+        return max_pool(self.word_encoder(relation_words_repre,relation_words_lengths.cpu(),need_sort=True)[0],relation_words_mask) # bsize * (2*hidden)
+
+    def get_relation_embedding(self,relations=None):
+        # relations=None: the whole catalog; otherwise only the given relation ids, where the RGCN
+        # propagates over their k-hop in-neighbourhood instead of the full graph
         if self.args.use_gcn:
             relation_embedding = []
             for gcn in self.gcns:
-                embed = gcn.forward()
+                if relations is None:
+                    embed = gcn.forward()
+                else:
+                    embed = gcn.forward_nodes(relations,self.rgcn_fanout)
                 relation_embedding.append(embed)
             if self.args.graph_aggr == 'concat':
                 return torch.cat(relation_embedding,dim=1)
@@ -87,12 +140,11 @@ class SimpleQA(nn.Module):
             elif self.args.graph_aggr == 'max':
                 return torch.stack(relation_embedding,dim=0).max(0)[0]
         else:
-            all_relations = torch.tensor([i for i in range(self.n_relations)]).to(device)
-            return self.relation_embedding(all_relations)
+            if relations is None:
+                relations = torch.tensor([i for i in range(self.n_relations)]).to(device)
+            return self.relation_embedding(relations)
 
-    def forward(self,question,relation):
-
-        n_rels = relation.size()[1]
+    def encode_question(self,question):
         question_length = (question != self.args.padding_idx).sum(dim=1).long().to(device)
         question_mask = (question != self.args.padding_idx)
         question = self.word_embedding(question)
@@ -100,108 +152,253 @@ class SimpleQA(nn.Module):
 
         high_question_repre = self.question_encoder(low_question_repre,question_length,need_sort=True)[0]
         question_repre = (low_question_repre + high_question_repre)  # bsize * seq_len * (2*hidden)
-        question_repre = max_pool(question_repre,question_mask) # bsize * (2*hidden)
+        return max_pool(question_repre,question_mask) # bsize * (2*hidden)
 
+    def get_relation_repre(self,relations=None):
         # single relation repre
-        single_relation_repre = self.get_relation_embedding().unsqueeze(1)
-        single_relation_repre = self.word_encoder(single_relation_repre,torch.tensor([1]*self.n_relations),need_sort=True)[0] # bsize * 1 * (2*hidden)
+        single_relation_repre = self.get_relation_embedding(relations).unsqueeze(1)
+        n_relations = single_relation_repre.size(0)
+        single_relation_repre = self.word_encoder(single_relation_repre,torch.tensor([1]*n_relations),need_sort=True)[0] # bsize * 1 * (2*hidden)
 
         # relation words repre
-        all_relation_words = torch.tensor(self.all_relation_words).to(device)  # n_relations * max_len
-
-        relation_words_lengths = (all_relation_words != self.args.padding_idx).sum(dim=-1).long().to(device)
-        relation_words_mask = (all_relation_words != self.args.padding_idx)
-        relation_words_repre = self.word_embedding(all_relation_words)
-        relation_words_repre = max_pool(self.word_encoder(relation_words_repre,relation_words_lengths,need_sort=True)[0],relation_words_mask) # bsize * (2*hidden)
+        if relations is None:
+            relation_words_repre = self.encode_relation_words()
+        else:
+            relation_words_repre = self.encode_relation_words(self.relation_words[relations])
 
         # relation_repre = self.gate(single_relation_repre,relation_words_repre)
-        relation_repre = torch.cat([relation_words_repre.unsqueeze(1),single_relation_repre],dim=1).max(dim=1)[0]
-
-        relation_repre = relation_repre[relation,:]  # bsize * n_rels * hidden
-
-        scores = self.score_function(relation_repre,question_repre.unsqueeze(1).repeat(1,n_rels,1))
-
-        return scores
+        return torch.cat([relation_words_repre.unsqueeze(1),single_relation_repre],dim=1).max(dim=1)[0]  # n_relations * hidden
+
+    def build_relation_cache(self):
+        # the relation side does not depend on the question, so in eval mode it is computed once
+        if self.relation_cache_frozen:
+            return
+        with torch.no_grad():
+            self.relation_cache = F.normalize(self.get_relation_repre(),dim=-1,eps=1e-8)
+
+    def clear_relation_cache(self):
+        self.relation_cache = None
+
+    def get_normalized_relation_repre(self):
+        if self.relation_cache is not None and not self.training:
+            return self.relation_cache
+        return F.normalize(self.get_relation_repre(),dim=-1,eps=1e-8)
+
+    def forward(self,question,relation=None):
+        # cosine scores as one (bsize * hidden) @ (hidden * n_relations) matmul,
+        # gathered down to the candidate columns unless relation is None
+        question_repre = F.normalize(self.encode_question(question),dim=-1,eps=1e-8)
+        relation_repre = self.get_normalized_relation_repre()
+
+        # a reduced-precision relation cache is scored in its own dtype
+        scores = torch.mm(question_repre.to(relation_repre.dtype),relation_repre.t()).float()  # bsize * n_relations
+        if relation is None:
+            return scores
+        return scores.gather(1,relation)  # bsize * n_rels
+
+    def forward_sampled(self,question,relation):
+        # training path for --relation_sampling: only the relations that occur in the batch are encoded,
+        # so the relation side costs O(bsize * (1 + ns)) instead of O(n_relations)
+        batch_relations,inverse = torch.unique(relation,return_inverse=True)
+        question_repre = F.normalize(self.encode_question(question),dim=-1,eps=1e-8)
+        relation_repre = F.normalize(self.get_relation_repre(batch_relations),dim=-1,eps=1e-8)
+        scores = torch.mm(question_repre,relation_repre.t())  # bsize * n_batch_relations
+        return scores.gather(1,inverse)  # bsize * n_rels
+
+    def score_candidates(self,question,relation):
+        # returns masked scores, the relation id of every score column and the gold column
+        bsize = question.size()[0]
+        if self.score_all:
+            scores = self.forward(question)
+            scores[:,self.args.padding_idx] = -1e9
+            candidates = torch.arange(self.n_relations,device=scores.device).unsqueeze(0).expand(bsize,-1)
+            gold_idx = relation[:,0]
+        else:
+            relation_mask = (1e9*(relation != 0) - 1e9).float()  # 1 -> 0, 0 -> -1e9
+            scores = self.forward(question,relation) + relation_mask  # bsize * (1 + neg_num)
+            candidates = relation
+            gold_idx = torch.zeros(bsize,dtype=torch.long,device=relation.device)
+        return scores,candidates,gold_idx
 
-    def train_epoch(self,train_iter):
+    def build_index(self,index_type='exact',**kwargs):
+        # index over the whole relation catalog (seen and unseen), padding relation excluded
+        self.eval()
+        self.build_relation_cache()
+        ids = torch.arange(self.n_relations,device=self.relation_cache.device)
+        ids = ids[ids != self.args.padding_idx]
+        self.index = build_index(self.relation_cache[ids],index_type,ids=ids,**kwargs)
+        return self.index
+
+    def retrieve(self,question,k=10):
+        with torch.no_grad():
+            question_repre = self.encode_question(question)
+            return self.index.search(question_repre,k)
+
+    def train_epoch(self,train_iter,logfile=None,epoch=0):
         self.train()
 
-        total_batch = len(train_iter)
-        total = 0.
-        loss = 0.0
-        cur_batch = 1
-        correct = 0
-
+        meter = TrainingMeter(len(train_iter),self.args.log_interval)
+        end_time = time.time()
         for batch in train_iter:
             question = torch.tensor(batch['question']).to(device)
             relation = torch.tensor(batch['relation']).to(device)
             labels = torch.tensor(batch['labels']).to(device)
             bsize = question.size()[0]
+            start_time = time.time()
+            meter.add_time('data',start_time - end_time)
 
-            scores = self.forward(question,relation)  # bsize * (1 + ns)
+            if self.relation_sampling:
+                scores = self.forward_sampled(question,relation)  # bsize * (1 + ns)
+            else:
+                scores = self.forward(question,relation)  # bsize * (1 + ns)
             batch_loss = self.loss_fn(scores,labels)
+            forward_end_time = time.time()
+            meter.add_time('forward',forward_end_time - start_time)
+
             self.optimizer.zero_grad()
             batch_loss.backward()
             self.optimizer.step()
-            cur_batch += 1
+            self.clear_relation_cache()
+            end_time = time.time()
+            meter.add_time('backward',end_time - forward_end_time)
 
-            correct += (scores.argmax(dim=1) == labels).sum().item()
-            total += bsize
+            meter.update(batch_loss,(scores.argmax(dim=1) == labels).sum(),bsize)
 
-            loss += batch_loss
-            print('\r Batch {}/{}, Training Loss:{:.4f}, Training Acc:{:.2f}'.format(cur_batch,total_batch,loss/cur_batch,correct/total*100),end='')
+        return meter.log_summary(epoch,logfile)
 
     def evaluate(self,dev_iter):
         self.eval()
-        total = 0
-        pred = []
-        gold = []
+        self.build_relation_cache()
+        accumulator = MetricAccumulator(self.n_relations)
         for batch in dev_iter:
             question = torch.tensor(batch['question']).to(device)
             relation = torch.tensor(batch['relation']).to(device)
             labels = torch.tensor(batch['labels']).to(device)
             bsize = question.size()[0]
 
-            gold.extend(relation[range(bsize),labels].tolist())
+            scores,candidates,_ = self.score_candidates(question,relation)
+            correct_idx = scores.argmax(dim=1)
+            accumulator.update(candidates[range(bsize),correct_idx],relation[range(bsize),labels])
 
-            relation_mask = (1e9*(relation != 0) - 1e9).float()  # 1 -> 0, 0 -> -1e9
-            scores = self.forward(question,relation)  # bsize * (1 + neg_num)
-            correct_idx = (scores+relation_mask).argmax(dim=1)
-            pred.extend(relation[range(bsize),correct_idx].tolist())
-            total += bsize
-
-        return micro_precision(pred,gold),macro_precision(pred,gold)
+        return accumulator.micro(),accumulator.macro()
 
-    def predict(self,dev_iter):
+    def evaluate_breakdown(self,dev_iter,seen_mask):
+        # single pass over the full test set, split into seen / unseen by the gold relation
         self.eval()
-        total = 0
+        self.build_relation_cache()
         pred = []
-        k_preds = []
         gold = []
-        ranks = []
         for batch in dev_iter:
             question = torch.tensor(batch['question']).to(device)
             relation = torch.tensor(batch['relation']).to(device)
-            labels = torch.tensor(batch['labels']).to(device)
             bsize = question.size()[0]
 
-            gold.extend(relation[range(bsize),labels].tolist())
+            scores,candidates,_ = self.score_candidates(question,relation)
+            correct_idx = scores.argmax(dim=1)
+            gold.append(relation[:,0].cpu().numpy())
+            pred.append(candidates[range(bsize),correct_idx].cpu().numpy())
 
-            relation_mask = (1e9*(relation != 0) - 1e9).float()  # 1 -> 0, 0 -> -1e9
-            scores = self.forward(question,relation)  # bsize * (1 + neg_num)
-            correct_idx = (scores+relation_mask).argmax(dim=1)
-            pred.extend(relation[range(bsize),correct_idx].tolist())
-
-            k_largest_idx = (scores+relation_mask).topk(k=5,dim=1,sorted=True)[1]
-            kp = np.zeros((bsize,5))
-            for i in range(bsize):
-                for j in range(5):
-                    kp[i][j] = relation[i][k_largest_idx[i][j]]
-            k_preds.extend(kp.tolist())
+        return precision_breakdown(np.concatenate(pred),np.concatenate(gold),seen_mask,self.n_relations)
 
-            rank_idx = ((scores+relation_mask).argsort(dim=1,descending=True).argsort(dim=1)[:,0]+1).tolist()
+    def predict_batches(self,dev_iter,k=5):
+        # yields gold, top-1, top-k and gold rank per batch as numpy arrays
+        self.eval()
+        self.build_relation_cache()
+        for batch in dev_iter:
+            question = torch.tensor(batch['question']).to(device)
+            relation = torch.tensor(batch['relation']).to(device)
+            bsize = question.size()[0]
 
-            ranks.extend(rank_idx)
-            total += bsize
+            scores,candidates,gold_idx = self.score_candidates(question,relation)
+            gold = relation[:,0]
+
+            # candidate lists are only padded to the batch maximum, which can be shorter than k
+            top_idx = scores.topk(k=min(k,scores.size(1)),dim=1,sorted=True)[1]
+            k_preds = candidates.gather(1,top_idx)
+            if k_preds.size(1) < k:
+                k_preds = torch.cat([k_preds,k_preds.new_zeros(bsize,k - k_preds.size(1))],dim=1)
+
+            # rank of gold = 1 + number of candidates scoring strictly above it
+            gold_scores = scores.gather(1,gold_idx.unsqueeze(1))
+            ranks = (scores > gold_scores).sum(dim=1) + 1
+
+            yield gold.cpu().numpy(),k_preds[:,0].cpu().numpy(),k_preds.cpu().numpy(),ranks.cpu().numpy()
+
+    def predict(self,dev_iter,k=5):
+        n_examples = len(dev_iter.dataset)
+        gold = np.zeros(n_examples,dtype=np.int64)
+        pred = np.zeros(n_examples,dtype=np.int64)
+        k_preds = np.zeros((n_examples,k),dtype=np.int64)
+        ranks = np.zeros(n_examples,dtype=np.int64)
+        offset = 0
+        for batch_gold,batch_pred,batch_k_preds,batch_ranks in self.predict_batches(dev_iter,k):
+            end = offset + len(batch_gold)
+            gold[offset:end] = batch_gold
+            pred[offset:end] = batch_pred
+            k_preds[offset:end] = batch_k_preds
+            ranks[offset:end] = batch_ranks
+            offset = end
 
         return gold,pred,k_preds,ranks
+
+    def retrieval_report(self,dev_iter,k=10,index_type='ivf',**kwargs):
+        # catalog-wide hits@k of the exact index and, for an approximate index, its recall@k against exact search
+        exact_index = self.build_index('exact')
+        approx_index = build_index(exact_index.vectors,index_type,ids=exact_index.ids,**kwargs) if index_type != 'exact' else None
+        total = 0
+        exact_hits = 0
+        approx_hits = 0
+        recall = 0.
+        exact_time = approx_time = 0.
+        with torch.no_grad():
+            for batch in dev_iter:
+                question = torch.tensor(batch['question']).to(device)
+                gold = torch.tensor(batch['relation'])[:,0].to(device)
+                bsize = question.size()[0]
+                question_repre = self.encode_question(question)
+
+                start_time = time.time()
+                _,exact_ids = exact_index.search(question_repre,k)
+                exact_time += time.time() - start_time
+                exact_hits += (exact_ids == gold.unsqueeze(1)).any(dim=1).sum().item()
+
+                if approx_index is not None:
+                    start_time = time.time()
+                    _,approx_ids = approx_index.search(question_repre,k)
+                    approx_time += time.time() - start_time
+                    approx_hits += (approx_ids == gold.unsqueeze(1)).any(dim=1).sum().item()
+                    recall += recall_at_k(approx_ids,exact_ids,k) * bsize
+                total += bsize
+        report = {'exact_hits@{}'.format(k):exact_hits / total,'exact_time':exact_time}
+        if approx_index is not None:
+            report['{}_hits@{}'.format(index_type,k)] = approx_hits / total
+            report['{}_recall@{}'.format(index_type,k)] = recall / total
+            report['{}_time'.format(index_type)] = approx_time
+        return report
+
+    def relation_side_report(self,repeat=20):
+        # per-step cost of encoding every relation's words in training mode (forward + backward):
+        # rebuilding, counting and sorting the padded tensor each step vs the pre-packed buffers
+        self.train()
+        report = dict()
+        paths = [
+            ('padded_ms',lambda: self.encode_relation_words(torch.tensor(self.all_relation_words).to(device))),
+            ('packed_ms',lambda: self.encode_relation_words()),
+        ]
+        for name,encode in paths:
+            for step in range(repeat + 1):
+                if step == 1:
+                    # first step warms up (and fills the memoized embedding, if any)
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    start_time = time.time()
+                self.optimizer.zero_grad()
+                encode().sum().backward()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            report[name] = (time.time() - start_time) / repeat * 1000
+        self.optimizer.zero_grad()
+        with torch.no_grad():
+            report['max_abs_diff'] = (self.encode_relation_words(torch.tensor(self.all_relation_words).to(device)) - self.encode_relation_words()).abs().max().item()
+        report['memoized_embedding'] = self.memoize_relation_words
+        return report
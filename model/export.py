@@ -0,0 +1,84 @@
+import copy
+import json
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Tuple
+from torch.nn.utils.rnn import pack_padded_sequence,pad_packed_sequence
+
+# Only torch is imported here, so an exported predictor can be loaded without DGL or the training code.
+
+
+class QuestionEncoder(nn.Module):
+    # word embedding + the two LSTM encoders + max_pool of SimpleQA.encode_question, in scriptable form
+
+    def __init__(self,word_embedding,word_rnn,question_rnn,padding_idx):
+        super(QuestionEncoder, self).__init__()
+        self.word_embedding = nn.Embedding.from_pretrained(word_embedding.weight.detach().clone().float(),freeze=True)
+        self.word_rnn = copy.deepcopy(word_rnn)
+        self.question_rnn = copy.deepcopy(question_rnn)
+        self.padding_idx = padding_idx
+
+    def forward(self,question):
+        lengths = (question != self.padding_idx).sum(dim=1).cpu()
+        inputs = self.word_embedding(question)
+
+        packed = pack_padded_sequence(inputs,lengths,batch_first=True,enforce_sorted=False)
+        low_question_repre,_ = pad_packed_sequence(self.word_rnn(packed)[0],batch_first=True)
+
+        packed = pack_padded_sequence(low_question_repre,lengths,batch_first=True,enforce_sorted=False)
+        high_question_repre,_ = pad_packed_sequence(self.question_rnn(packed)[0],batch_first=True)
+
+        question_repre = low_question_repre + high_question_repre
+        question_repre = question_repre.masked_fill(question_repre == 0,-1e9).max(dim=1)[0]
+        return F.normalize(question_repre,dim=-1,eps=1e-8)
+
+
+class ExportedPredictor(nn.Module):
+    # question encoder plus the frozen, normalized relation matrix; returns top-k scores and relation ids
+
+    def __init__(self,encoder,relations,padding_idx):
+        super(ExportedPredictor, self).__init__()
+        self.encoder = encoder
+        self.register_buffer('relations',relations)
+        mask = torch.zeros(relations.size(0))
+        mask[padding_idx] = -1e9
+        self.register_buffer('relation_mask',mask)
+
+    def forward(self,question,k:int) -> Tuple[torch.Tensor,torch.Tensor]:
+        scores = torch.mm(self.encoder(question),self.relations.t()) + self.relation_mask
+        return scores.topk(k,dim=1)
+
+
+def export_model(model,vocab,path):
+    model.eval()
+    model.build_relation_cache()
+    encoder = QuestionEncoder(model.word_embedding,model.word_encoder.rnn,model.question_encoder.rnn,model.args.padding_idx)
+    predictor = ExportedPredictor(encoder,model.relation_cache.detach().float().cpu(),model.args.padding_idx).cpu().eval()
+    extra_files = {'vocab.json':json.dumps({
+        'stoi':vocab.stoi,
+        'itor':[vocab.itor[i] for i in range(len(vocab.itor))],
+        'padding_idx':model.args.padding_idx,
+    })}
+    torch.jit.save(torch.jit.script(predictor),path,_extra_files=extra_files)
+
+
+class LoadedPredictor(object):
+
+    def __init__(self,path,device='cpu'):
+        extra_files = {'vocab.json':''}
+        self.module = torch.jit.load(path,map_location=device,_extra_files=extra_files)
+        vocab = json.loads(extra_files['vocab.json'])
+        self.stoi = vocab['stoi']
+        self.itor = vocab['itor']
+        self.padding_idx = vocab['padding_idx']
+        self.device = device
+
+    def predict(self,questions,k=5):
+        tokens = [[self.stoi.get(word,1) for word in q.split()] or [1] for q in questions]
+        question = torch.full((len(tokens),max(len(t) for t in tokens)),self.padding_idx,dtype=torch.long)
+        for i,t in enumerate(tokens):
+            question[i,:len(t)] = torch.tensor(t)
+        with torch.no_grad():
+            scores,ids = self.module(question.to(self.device),k)
+        return [[(self.itor[r],s) for r,s in zip(row_ids,row_scores)] for row_ids,row_scores in zip(ids.tolist(),scores.tolist())]
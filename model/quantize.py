@@ -0,0 +1,38 @@
+import torch
+import torch.nn as nn
+
+
+class LowPrecisionEmbedding(nn.Module):
+    # embedding table stored as bfloat16 or per-row int8, looked-up rows are returned as float32
+
+    def __init__(self,weight,dtype='bfloat16'):
+        super(LowPrecisionEmbedding, self).__init__()
+        self.dtype = dtype
+        weight = weight.detach().float()
+        if dtype == 'bfloat16':
+            self.register_buffer('weight',weight.to(torch.bfloat16))
+            self.scale = None
+        elif dtype == 'int8':
+            scale = (weight.abs().max(dim=1)[0] / 127.).clamp(min=1e-12)
+            self.register_buffer('weight',torch.round(weight / scale.unsqueeze(1)).to(torch.int8))
+            self.register_buffer('scale',scale)
+        else:
+            raise ValueError('Unknown embedding dtype: {}'.format(dtype))
+
+    def forward(self,input):
+        rows = self.weight[input].float()
+        if self.scale is not None:
+            rows = rows * self.scale[input].unsqueeze(-1)
+        return rows
+
+
+def quantize_for_inference(model,embedding_dtype='bfloat16',relation_dtype=torch.bfloat16):
+    # the relation side is computed once in float32 and frozen in reduced precision,
+    # then LSTM / Linear layers are dynamically quantized to int8 for question encoding
+    model.eval()
+    model.build_relation_cache()
+    model.relation_cache = model.relation_cache.to(relation_dtype)
+    model.relation_cache_frozen = True
+    model.word_embedding = LowPrecisionEmbedding(model.word_embedding.weight,embedding_dtype)
+    torch.quantization.quantize_dynamic(model,{nn.LSTM,nn.Linear},dtype=torch.qint8,inplace=True)
+    return model
@@ -0,0 +1,259 @@
+import torch
+import os
+import json
+import time
+import asyncio
+import numpy as np
+from collections import deque
+from pprint import pprint
+from model.SimpleQA import SimpleQA
+from utils.util import parse_args
+from train_simpleqa import build_arg_parser,prepare
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+class LatencyStats(object):
+    def __init__(self,window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.count = 0
+        self.start_time = time.time()
+
+    def add(self,latency):
+        self.latencies.append(latency)
+        self.count += 1
+
+    def summary(self):
+        latencies = np.array(self.latencies) * 1000
+        elapsed = time.time() - self.start_time
+        return {
+            'requests':self.count,
+            'qps':self.count / elapsed if elapsed > 0 else 0.,
+            'p50_ms':float(np.percentile(latencies,50)) if len(latencies) else 0.,
+            'p99_ms':float(np.percentile(latencies,99)) if len(latencies) else 0.,
+            'mean_batch_size':float(np.mean(self.batch_sizes)) if len(self.batch_sizes) else 0.,
+        }
+
+
+class RelationPredictor(object):
+    # loads vocab, graphs and checkpoint once and keeps the relation index resident
+
+    def __init__(self,args):
+        self.vocab = prepare(args)
+        args.padding_idx = 0
+        self.model = SimpleQA(args).to(device)
+        self.model.load_state_dict(torch.load(args.checkpoint,map_location=device))
+        self.model.build_index('exact')
+        self.padding_idx = args.padding_idx
+
+    def tokenize(self,question):
+        tokens = [self.vocab.stoi.get(word,1) for word in question.split()]
+        return tokens if tokens else [1]
+
+    def predict(self,questions,k):
+        tokens = [self.tokenize(q) for q in questions]
+        question = np.full((len(tokens),max(len(t) for t in tokens)),self.padding_idx,dtype=np.int64)
+        for i,t in enumerate(tokens):
+            question[i,:len(t)] = t
+        scores,ids = self.model.retrieve(torch.from_numpy(question).to(device),k)
+        scores,ids = scores.tolist(),ids.tolist()
+        # an approximate index marks unfilled top-k slots with id -1
+        return [[{'relation':self.vocab.itor[r],'score':s} for r,s in zip(row_ids,row_scores) if r >= 0] for row_ids,row_scores in zip(ids,scores)]
+
+
+class MicroBatcher(object):
+    # concurrent requests are queued and flushed as one batch when max_batch_size is reached
+    # or the oldest request has waited max_wait_ms
+
+    def __init__(self,predictor,max_batch_size=32,max_wait_ms=5.,k=5):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.k = k
+        self.queue = asyncio.Queue()
+        self.stats = LatencyStats()
+
+    async def submit(self,question,k=None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((question,k or self.k,future,time.time()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),timeout))
+                except asyncio.TimeoutError:
+                    break
+            questions = [item[0] for item in batch]
+            k = max(item[1] for item in batch)
+            try:
+                results = await loop.run_in_executor(None,self.predictor.predict,questions,k)
+            except Exception as e:
+                for _,_,future,_ in batch:
+                    # the waiting handler may have been cancelled (client gone)
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.time()
+            self.stats.batch_sizes.append(len(batch))
+            for (_,item_k,future,arrival),result in zip(batch,results):
+                self.stats.add(now - arrival)
+                if not future.done():
+                    future.set_result(result[:item_k])
+
+
+async def read_request(reader):
+    request_line = (await reader.readline()).decode().rstrip()
+    if not request_line:
+        return None,None,None
+    parts = request_line.split(' ',2)
+    if len(parts) != 3:
+        raise ValueError('malformed request line')
+    method,path,_ = parts
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode().rstrip()
+        if not line:
+            break
+        if ':' not in line:
+            raise ValueError('malformed header line')
+        key,value = line.split(':',1)
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length',0))
+    if length < 0:
+        raise ValueError('negative Content-Length')
+    body = await reader.readexactly(length)
+    return method,path,body
+
+
+def write_response(writer,status,data):
+    body = json.dumps(data).encode()
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(status,len(body)).encode() + body)
+
+
+def parse_predict_request(body):
+    request = json.loads(body or b'{}')
+    if not isinstance(request,dict):
+        raise TypeError('request body must be a JSON object')
+    question = request['question']
+    if not isinstance(question,str):
+        raise TypeError('question must be a string')
+    k = request.get('k')
+    if k is not None and (not isinstance(k,int) or isinstance(k,bool) or k <= 0):
+        raise ValueError('k must be a positive integer')
+    return question,k
+
+
+def make_handler(batcher):
+    async def handle(reader,writer):
+        try:
+            while True:
+                try:
+                    method,path,body = await read_request(reader)
+                except ValueError as e:
+                    # the stream position is unknown after a bad request, so answer and close
+                    write_response(writer,'400 Bad Request',{'error':str(e)})
+                    await writer.drain()
+                    break
+                if method is None:
+                    break
+                if method == 'POST' and path == '/predict':
+                    try:
+                        question,k = parse_predict_request(body)
+                    except (ValueError,KeyError,TypeError) as e:
+                        write_response(writer,'400 Bad Request',{'error':str(e)})
+                    else:
+                        try:
+                            result = await batcher.submit(question,k)
+                        except Exception as e:
+                            write_response(writer,'500 Internal Server Error',{'error':str(e)})
+                        else:
+                            write_response(writer,'200 OK',{'relations':result})
+                elif method == 'GET' and path == '/stats':
+                    write_response(writer,'200 OK',batcher.stats.summary())
+                else:
+                    write_response(writer,'404 Not Found',{'error':'unknown endpoint'})
+                await writer.drain()
+        except (asyncio.IncompleteReadError,ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def post(host,port,question,k):
+    reader,writer = await asyncio.open_connection(host,port)
+    body = json.dumps({'question':question,'k':k}).encode()
+    writer.write('POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(host,len(body)).encode() + body)
+    await writer.drain()
+    status = await reader.readline()
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode().rstrip()
+        if not line:
+            break
+        key,value = line.split(':',1)
+        headers[key.strip().lower()] = value.strip()
+    response = json.loads(await reader.readexactly(int(headers['content-length'])))
+    writer.close()
+    return response
+
+
+async def benchmark(host,port,questions,n_requests,concurrency,k):
+    # closed-loop load: `concurrency` clients each send requests back to back
+    counter = iter(range(n_requests))
+
+    async def client():
+        for i in counter:
+            await post(host,port,questions[i % len(questions)],k)
+
+    start_time = time.time()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.time() - start_time
+    print('Sent {} requests with concurrency {} in {:.2f}s ({:.1f} QPS)'.format(n_requests,concurrency,elapsed,n_requests / elapsed))
+
+
+def load_questions(fname):
+    with open(fname,'r') as f:
+        return [line.rstrip().split('\t')[2] for line in f]
+
+
+async def serve(args):
+    predictor = RelationPredictor(args)
+    batcher = MicroBatcher(predictor,args.max_batch_size,args.max_wait_ms,args.topk)
+    batch_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(make_handler(batcher),args.host,args.port)
+    print('Serving on {}:{}'.format(args.host,args.port))
+    async with server:
+        if args.bench > 0:
+            questions = load_questions(args.bench_file)
+            await benchmark(args.host,args.port,questions,args.bench,args.concurrency,args.topk)
+            pprint(batcher.stats.summary())
+        else:
+            await server.serve_forever()
+    batch_task.cancel()
+
+
+if __name__ == '__main__':
+
+    args_parser = build_arg_parser()
+    args_parser.add_argument('--checkpoint',default=None)
+    args_parser.add_argument('--host',default='127.0.0.1')
+    args_parser.add_argument('--port',type=int,default=8080)
+    args_parser.add_argument('--max_batch_size',type=int,default=32)
+    args_parser.add_argument('--max_wait_ms',type=float,default=5.)
+    args_parser.add_argument('--bench',type=int,default=0)
+    args_parser.add_argument('--bench_file',default=None)
+    args_parser.add_argument('--concurrency',type=int,default=16)
+    args = parse_args(args_parser)
+    if args.checkpoint is None:
+        args.checkpoint = os.path.join(args.save_dir,'model.pth')
+    asyncio.run(serve(args))
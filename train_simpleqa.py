@@ -1,15 +1,25 @@
 import torch
 import os
+import sys
+import subprocess
 import numpy as np
 import json
+import time
+import copy
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
 from argparse import ArgumentParser
 from torch.utils.data import DataLoader
-from dataloader.simpleQA_dataloader import SimpleQADataset
+from dataloader.simpleQA_dataloader import SimpleQADataset,NegativeSamplingCollator
+from dataloader.sampler import BucketBatchSampler,get_lengths
 from model.SimpleQA import SimpleQA
-from utils.graph_util import build_graph_from_adj_matrix,get_seen_density
-from utils.visualize import plot_embedding,plot_density
+from model.quantize import quantize_for_inference
+from model.export import export_model,LoadedPredictor
+from utils.graph_util import load_relation_graph,get_seen_density,load_adj_matrix,neighbour_degrees
 from utils.util import parse_args,pairwise_distances
+from utils.metric import MetricAccumulator
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -24,27 +34,22 @@ def generate_folds(labelset,K=10):
     return folds
 
 
-def main(args):
+def prepare(args):
 
     import time
+    timings = dict()
     start_time = time.time()
     vocab = SimpleQADataset.load_vocab(args)
     end_time = time.time()
+    timings['vocab'] = end_time - start_time
     print('Loaded dataset in {:.2f}s'.format(end_time - start_time))
 
     if args.use_gcn:
         args.relation_graphs = []
         args.adj_matrix = []
+        print('Building Relation Graph ...')
         for pth in args.relation_adj_matrix_pth:
-            adj_matrix = torch.load(pth)
-            print('Relation Adj matrix loaded!')
-            print('Building Relation Graph ...')
-            if not args.self_loop:
-                # remove self loop
-                print('Removing Self-Loop')
-                for i in range(adj_matrix.shape[0]):
-                    adj_matrix[i][i] = 0
-            g = build_graph_from_adj_matrix(adj_matrix,device,args.norm_type)
+            adj_matrix,g = load_relation_graph(pth,device,args.norm_type,args.self_loop,args.gcn_backend,timings=timings)
             print('Done.')
             args.adj_matrix.append(adj_matrix)
             args.relation_graphs.append(g)
@@ -57,6 +62,7 @@ def main(args):
     args.n_relations = len(vocab.rtoi)
     args.all_relation_words = vocab.get_all_relation_words()
 
+    start_time = time.time()
     if args.word_pretrained_pth is not None:
         args.word_pretrained = torch.load(args.word_pretrained_pth)
         print(' Pretrained word embedding loaded!')
@@ -70,6 +76,19 @@ def main(args):
     else:
         args.relation_pretrained = None
         print(' Using random initialized label word embedding.')
+    timings['embeddings'] = time.time() - start_time
+
+    print('Startup time: ' + ', '.join('{} {:.2f}s'.format(name,t) for name,t in timings.items()))
+    return vocab
+
+
+def main(args):
+
+    if args.train and args.relation_sampling and args.use_gcn and args.gcn_backend != 'sparse':
+        # the DGL graph has no k-hop block path, every step would still run the full-graph RGCN
+        raise ValueError('--relation_sampling with use_gcn requires --gcn_backend sparse')
+
+    vocab = prepare(args)
 
     if not os.path.exists(args.save_dir):
         os.mkdir(args.save_dir)
@@ -89,55 +108,141 @@ def main(args):
             print(' Test Acc on origin dataset: {:.2f},{:.2f}'.format(test_micro_acc,test_macro_acc))
 
     elif args.dataset == 'mix':
-        for i in range(args.fold):
-            train_fname = os.path.join(base_data_dir,'fold-{}'.format(i),'train.tsv')
-            dev_fname = os.path.join(base_data_dir,'fold-{}'.format(i),'dev.tsv')
-            test_fname = os.path.join(base_data_dir,'fold-{}'.format(i),'test.tsv')
-            test_seen_fname = os.path.join(base_data_dir,'fold-{}'.format(i),'test_seen.tsv')
-            test_unseen_fname = os.path.join(base_data_dir,'fold-{}'.format(i),'test_unseen.tsv')
-            train_dataset,dev_dataset,test_dataset,test_seen_dataset,test_unseen_dataset = SimpleQADataset.load_dataset([train_fname,dev_fname,test_fname,test_seen_fname,test_unseen_fname],args.vocab_pth,args)
-            args.save_dir = os.path.join(base_save_dir,'fold-{}'.format(str(i)))
-
-            train_relations = train_dataset.get_label_set()
-            args.seen_idx = list(train_relations)
-            args.unseen_idx = list(set([i for i in range(len(vocab.rtoi))]) - set(args.seen_idx))
-            label_idx = np.zeros(len(vocab.rtoi))
-            label_idx[args.seen_idx] = 1
-            args.label_idx = label_idx
-
-            if args.train:
-                print(' Training Fold {}'.format(i))
-                train(args,train_dataset,dev_dataset,test_dataset,vocab,SimpleQADataset.collate_fn)
-            elif args.evaluate:
-                with torch.no_grad():
-                    print(' Test Fold {}'.format(i))
-                    # All
-                    test_micro_acc,test_macro_acc = evaluate(args,test_dataset,vocab,SimpleQADataset.collate_fn)
-                    print('Test Acc :({:.2f},{:.2f})'.format(test_micro_acc*100,test_macro_acc*100))
-
-                    # Seen
-                    seen_micro_acc,seen_macro_acc = evaluate(args,test_seen_dataset,vocab,SimpleQADataset.collate_fn)
-                    print('Seen Acc :({:.2f},{:.2f})'.format(seen_micro_acc*100,seen_macro_acc*100))
-
-                    # Unseen
-                    unseen_micro_acc,unseen_macro_acc = evaluate(args,test_unseen_dataset,vocab,SimpleQADataset.collate_fn)
-                    print('UnSeen Acc :({:.2f},{:.2f})'.format(unseen_micro_acc*100,unseen_macro_acc*100))
-            elif args.visualize:
-                print(' Visualizing Fold {}'.format(i))
-                fname = os.path.join(args.save_dir,'embedding.png')
-                visualize(args,label_idx,vocab,fname)
-            elif args.analysis:
-                print(' Analyzing Fold {}'.format(i))
-                first_order_fname = os.path.join(args.save_dir,'first_order.png')
-                second_order_fname = os.path.join(args.save_dir,'second_order.png')
-                analysis(args,vocab,test_dataset,SimpleQADataset.collate_fn,first_order_fname,second_order_fname)
+        args.base_save_dir = base_save_dir
+        if args.fold_workers > 1 and torch.cuda.is_available():
+            print(' Parallel folds are CPU only, running folds sequentially')
+            args.fold_workers = 1
+        if args.fold_workers > 1:
+            results = run_folds_parallel(args,vocab)
+        else:
+            results = [run_fold(args,vocab,i) for i in range(args.fold)]
+        summarize_folds(results)
+
+
+def run_fold(args,vocab,i):
+    args = copy.copy(args)
+    # from_pretrained trains the given tensor in place, so each fold starts from a private copy
+    for name in ['word_pretrained','relation_pretrained']:
+        if getattr(args,name) is not None:
+            setattr(args,name,getattr(args,name).clone())
+    result = dict()
+    train_fname = os.path.join(args.data_dir,'fold-{}'.format(i),'train.tsv')
+    dev_fname = os.path.join(args.data_dir,'fold-{}'.format(i),'dev.tsv')
+    test_fname = os.path.join(args.data_dir,'fold-{}'.format(i),'test.tsv')
+    train_dataset,dev_dataset,test_dataset = SimpleQADataset.load_dataset([train_fname,dev_fname,test_fname],args.vocab_pth,args)
+    args.save_dir = os.path.join(args.base_save_dir,'fold-{}'.format(str(i)))
+
+    train_relations = train_dataset.get_label_set()
+    args.seen_idx = list(train_relations)
+    args.unseen_idx = list(set([i for i in range(len(vocab.rtoi))]) - set(args.seen_idx))
+    label_idx = np.zeros(len(vocab.rtoi))
+    label_idx[args.seen_idx] = 1
+    args.label_idx = label_idx
+
+    if args.train:
+        print(' Training Fold {}'.format(i))
+        test_acc = train(args,train_dataset,dev_dataset,test_dataset,vocab,SimpleQADataset.collate_fn)
+        if test_acc is not None:
+            result['test_micro'],result['test_macro'] = test_acc
+    elif args.evaluate:
+        with torch.no_grad():
+            print(' Test Fold {}'.format(i))
+            breakdown = evaluate_breakdown(args,test_dataset,vocab,SimpleQADataset.collate_fn)
+            for name,title in [('all','Test'),('seen','Seen'),('unseen','UnSeen')]:
+                micro_acc,macro_acc = breakdown[name]
+                print('{} Acc :({:.2f},{:.2f})'.format(title,micro_acc*100,macro_acc*100))
+                result['{}_micro'.format('test' if name == 'all' else name)] = micro_acc
+                result['{}_macro'.format('test' if name == 'all' else name)] = macro_acc
+    elif args.export:
+        print(' Exporting Fold {}'.format(i))
+        result = export(args,test_dataset,vocab)
+        pprint(result)
+    elif args.quantize:
+        print(' Quantized inference on Fold {}'.format(i))
+        result = quantization_report(args,test_dataset,vocab,SimpleQADataset.collate_fn)
+        pprint(result)
+    elif args.retrieve:
+        print(' Retrieval on Fold {}'.format(i))
+        result = retrieve(args,test_dataset,vocab,SimpleQADataset.collate_fn)
+        pprint(result)
+    elif args.bench_relation:
+        print(' Relation side benchmark on Fold {}'.format(i))
+        result = relation_side_benchmark(args,vocab)
+        pprint(result)
+    elif args.visualize:
+        print(' Visualizing Fold {}'.format(i))
+        fname = os.path.join(args.save_dir,'embedding.png')
+        visualize(args,label_idx,vocab,fname)
+    elif args.analysis:
+        print(' Analyzing Fold {}'.format(i))
+        first_order_fname = os.path.join(args.save_dir,'first_order.png')
+        second_order_fname = os.path.join(args.save_dir,'second_order.png')
+        analysis(args,vocab,test_dataset,SimpleQADataset.collate_fn,first_order_fname,second_order_fname)
+    return result
+
+
+# state handed to fold workers through fork, so vocab, graphs and embeddings are loaded once
+_fold_state = {}
+
+
+def init_fold_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+
+def run_fold_in_worker(i):
+    return run_fold(_fold_state['args'],_fold_state['vocab'],i)
+
+
+def run_folds_parallel(args,vocab):
+    n_threads = max(1,(os.cpu_count() or 1) // args.fold_workers)
+    args.num_workers = max(0,args.num_workers // args.fold_workers)
+    for name in ['word_pretrained','relation_pretrained']:
+        if getattr(args,name) is not None:
+            getattr(args,name).share_memory_()
+    _fold_state['args'] = args
+    _fold_state['vocab'] = vocab
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=args.fold_workers,mp_context=ctx,initializer=init_fold_worker,initargs=(n_threads,)) as executor:
+        return list(executor.map(run_fold_in_worker,range(args.fold)))
+
+
+def is_percentage(key):
+    # precision / hits / recall keys are fractions shown as percentages, everything else (throughput,
+    # latency, startup, diffs) is printed as reported
+    return key.endswith('_micro') or key.endswith('_macro') or 'hits@' in key or 'recall@' in key
+
+
+def summarize_folds(results):
+    keys = []
+    for result in results:
+        keys.extend(k for k in result if k not in keys and isinstance(result[k],float) and not k.endswith('time'))
+    if not keys:
+        return
+    print('\n{:<24}'.format('metric') + ''.join('{:>10}'.format('fold-{}'.format(i)) for i in range(len(results))) + '{:>10}{:>10}'.format('mean','stdev'))
+    for key in keys:
+        scale,fmt = (100,'{:>10.2f}') if is_percentage(key) else (1,'{:>10.4g}')
+        values = [result[key]*scale for result in results if key in result]
+        row = ''.join(fmt.format(result[key]*scale) if key in result else '{:>10}'.format('-') for result in results)
+        stdev = statistics.stdev(values) if len(values) > 1 else 0.
+        print('{:<24}'.format(key) + row + fmt.format(statistics.mean(values)) + fmt.format(stdev))
+
+
+def make_iter(args,dataset,batch_size,shuffle,collate_fn):
+    if args.bucket:
+        batch_sampler = BucketBatchSampler(get_lengths(dataset),batch_size,shuffle=shuffle)
+        return DataLoader(dataset=dataset,batch_sampler=batch_sampler,num_workers=args.num_workers,collate_fn=collate_fn)
+    return DataLoader(dataset=dataset,batch_size=batch_size,shuffle=shuffle,num_workers=args.num_workers,collate_fn=collate_fn)
 
 
 def train(args,train_dataset,dev_dataset,test_dataset,vocab,collate_fn):
 
-    train_iter = DataLoader(dataset=train_dataset,batch_size=args.batch_size,shuffle=True,num_workers=12,collate_fn=collate_fn)
-    dev_iter = DataLoader(dataset=dev_dataset,batch_size=32,shuffle=True,num_workers=12,collate_fn=collate_fn)
-    test_iter = DataLoader(dataset=test_dataset,batch_size=32,shuffle=True,num_workers=12,collate_fn=collate_fn)
+    if train_dataset.negative_sampler is not None:
+        train_collate_fn = NegativeSamplingCollator(train_dataset.negative_sampler,args.ns)
+    else:
+        train_collate_fn = collate_fn
+    train_iter = make_iter(args,train_dataset,args.batch_size,True,train_collate_fn)
+    dev_iter = make_iter(args,dev_dataset,32,True,collate_fn)
+    test_iter = make_iter(args,test_dataset,32,True,collate_fn)
 
     args.n_words = len(vocab.stoi)
     args.n_relations = len(vocab.rtoi)
@@ -155,7 +260,7 @@ def train(args,train_dataset,dev_dataset,test_dataset,vocab,collate_fn):
     test_acc = -1.
     logfile = open(os.path.join(args.save_dir,'log.txt'),'w')
     for epoch in range(args.epoch):
-        model.train_epoch(train_iter)
+        model.train_epoch(train_iter,logfile,epoch)
         with torch.no_grad():
             dev_acc = model.evaluate(dev_iter)
         patience -= 1
@@ -182,7 +287,7 @@ def train(args,train_dataset,dev_dataset,test_dataset,vocab,collate_fn):
 
 def evaluate(args,test_dataset,vocab,collate_fn):
 
-    test_iter = DataLoader(dataset=test_dataset,batch_size=args.batch_size,shuffle=True,num_workers=12,collate_fn=collate_fn)
+    test_iter = make_iter(args,test_dataset,args.batch_size,True,collate_fn)
     args.n_words = len(vocab.stoi)
     args.n_relations = len(vocab.rtoi)
     args.padding_idx = 0
@@ -192,6 +297,110 @@ def evaluate(args,test_dataset,vocab,collate_fn):
     return micro_acc,macro_acc
 
 
+def load_model(args,vocab):
+    args.n_words = len(vocab.stoi)
+    args.n_relations = len(vocab.rtoi)
+    args.padding_idx = 0
+    model = SimpleQA(args).to(device)
+    model.load_state_dict(torch.load(os.path.join(args.save_dir,'model.pth')))
+    return model
+
+
+def evaluate_breakdown(args,test_dataset,vocab,collate_fn):
+
+    test_iter = make_iter(args,test_dataset,args.batch_size,True,collate_fn)
+    model = load_model(args,vocab)
+    breakdown = model.evaluate_breakdown(test_iter,args.label_idx)
+    with open(os.path.join(args.save_dir,'relation_precision.tsv'),'w') as f:
+        f.write('Relation\tseen\tcount\tprecision\n')
+        for idx in np.nonzero(breakdown['relation_count'])[0]:
+            f.write('{}\t{}\t{}\t{:.4f}\n'.format(vocab.itor[idx],int(args.label_idx[idx]),breakdown['relation_count'][idx],breakdown['per_relation'][idx]))
+    return breakdown
+
+
+def export(args,test_dataset,vocab,n_requests=200):
+    # writes save_dir/predictor.pt and compares startup and single-question latency with the full model
+    path = os.path.join(args.save_dir,'predictor.pt')
+    export_model(load_model(args,vocab),vocab,path)
+
+    # the full model needs vocab, graphs and pretrained embeddings from prepare() before the checkpoint loads
+    start_time = time.time()
+    vocab = prepare(args)
+    full_prepare = time.time() - start_time
+    model = load_model(args,vocab)
+    model.build_index('exact')
+    full_startup = time.time() - start_time
+
+    start_time = time.time()
+    predictor = LoadedPredictor(path)
+    exported_startup = time.time() - start_time
+
+    questions = []
+    with open(test_dataset.filename,'r') as f:
+        for line in f:
+            questions.append(line.rstrip().split('\t')[2])
+            if len(questions) == n_requests:
+                break
+
+    full_latency = []
+    exported_latency = []
+    for question in questions:
+        tokens = [vocab.stoi.get(word,1) for word in question.split()] or [1]
+        start_time = time.time()
+        model.retrieve(torch.tensor([tokens]).to(device),5)
+        full_latency.append(time.time() - start_time)
+        start_time = time.time()
+        predictor.predict([question],5)
+        exported_latency.append(time.time() - start_time)
+    return {
+        'full_prepare':full_prepare,
+        'full_startup':full_startup,
+        'exported_startup':exported_startup,
+        'full_p50_ms':float(np.percentile(full_latency,50)) * 1000,
+        'exported_p50_ms':float(np.percentile(exported_latency,50)) * 1000,
+        'full_p99_ms':float(np.percentile(full_latency,99)) * 1000,
+        'exported_p99_ms':float(np.percentile(exported_latency,99)) * 1000,
+    }
+
+
+def quantization_report(args,test_dataset,vocab,collate_fn):
+    # accuracy and throughput of the int8 / bfloat16 model against float32 on the same batches
+    with torch.no_grad():
+        batches = list(make_iter(args,test_dataset,args.batch_size,False,collate_fn))
+        n_examples = sum(len(batch['labels']) for batch in batches)
+        report = dict()
+        for name in ['float32',args.embedding_dtype]:
+            model = load_model(args,vocab)
+            if name != 'float32':
+                model = quantize_for_inference(model,args.embedding_dtype)
+            # warm up and keep the relation cache, so only question-side throughput is timed
+            model.evaluate(batches[:1])
+            model.relation_cache_frozen = True
+            start_time = time.time()
+            micro_acc,macro_acc = model.evaluate(batches)
+            elapsed = time.time() - start_time
+            report['{}_micro'.format(name)] = micro_acc
+            report['{}_macro'.format(name)] = macro_acc
+            report['{}_examples_per_sec'.format(name)] = n_examples / elapsed
+    return report
+
+
+def retrieve(args,test_dataset,vocab,collate_fn):
+
+    test_iter = make_iter(args,test_dataset,args.batch_size,False,collate_fn)
+    model = load_model(args,vocab)
+    kwargs = {'n_lists':args.n_lists,'n_probe':args.n_probe} if args.index_type == 'ivf' else {}
+    return model.retrieval_report(test_iter,k=args.topk,index_type=args.index_type,**kwargs)
+
+
+def relation_side_benchmark(args,vocab):
+    args.n_words = len(vocab.stoi)
+    args.n_relations = len(vocab.rtoi)
+    args.padding_idx = 0
+    model = SimpleQA(args).to(device)
+    return model.relation_side_report()
+
+
 def visualize(args,labels,vocab,fname):
     args.n_words = len(vocab.stoi)
     args.n_relations = len(vocab.rtoi)
@@ -203,6 +412,7 @@ def visualize(args,labels,vocab,fname):
     else:
         relation_embedding = model.get_relation_embedding().detach().cpu().numpy()
 
+    from utils.visualize import plot_embedding
     # normalize
     # relation_embedding -= np.mean(relation_embedding,axis=0)
     np.savetxt('embedding.tsv',relation_embedding,delimiter='\t')
@@ -218,38 +428,31 @@ def visualize(args,labels,vocab,fname):
 
 
 def analysis(args,vocab,test_dataset,collate_fn,first_order_fname,second_order_fname):
+    from utils.visualize import plot_relation_density
     # Load Model
-    args.n_words = len(vocab.stoi)
-    args.n_relations = len(vocab.rtoi)
-    args.padding_idx = 0
-    model = SimpleQA(args).to(device)
-    model.load_state_dict(torch.load(os.path.join(args.save_dir,'model.pth')))
+    model = load_model(args,vocab)
 
     # Load Graph
-    adj_matrix = torch.load(args.relation_adj_matrix_pth[0])
+    adj_matrix = load_adj_matrix(args.relation_adj_matrix_pth[0])
+    total_degree,seen_degree,unseen_degree = neighbour_degrees(adj_matrix,args.label_idx)
+    seen = args.label_idx.astype(bool)
+
+    def relation_type(j):
+        return 'seen' if seen[j] else 'unseen'
 
     # Load Dataset
-    test_iter = DataLoader(dataset=test_dataset,batch_size=args.batch_size,shuffle=False,num_workers=12,collate_fn=collate_fn)
-    with torch.no_grad():
-        gold,pred,k_preds,ranks = model.predict(test_iter)
-        # if not args.use_gcn:
-        #     relation_embedding = model.get_relation_embedding()
-        # else:
-        #     relation_embedding = model.get_relation_embedding()
-        # pdist = pairwise_distances(relation_embedding)
-
-    # first_order_seen_density = get_seen_density(adj_matrix,args.seen_idx,args.unseen_idx,order=1)
-    # second_order_seen_density = get_seen_density(adj_matrix,args.seen_idx,args.unseen_idx,order=2)
-    # plot_density(pred,gold,first_order_seen_density,args.seen_idx,first_order_fname)
-    # plot_density(pred,gold,second_order_seen_density,args.seen_idx,second_order_fname)
-
-    with open(os.path.join(args.save_dir,'test.errors'),'w') as f:
-        outputs = []
-        for i,(p,g,k,r) in enumerate(zip(pred,gold,k_preds,ranks)):
-            if p != g:
-                raw_line = test_dataset.get_raw_instance(i)
-                gold,neg,question = raw_line.rstrip().split('\t')
-                gold_relation = vocab.itor[g]
+    test_iter = DataLoader(dataset=test_dataset,batch_size=args.batch_size,shuffle=False,num_workers=args.num_workers,collate_fn=collate_fn)
+    accumulator = MetricAccumulator(args.n_relations)
+
+    # errors are written as JSON Lines while batches are predicted; the loader is unshuffled,
+    # so raw lines are read from the test file in step with the batches
+    with torch.no_grad(),open(os.path.join(args.save_dir,'test.errors.jsonl'),'w') as f,open(test_dataset.filename,'r') as raw_file:
+        for gold,pred,k_preds,ranks in model.predict_batches(test_iter):
+            accumulator.update(pred,gold,ranks)
+            raw_lines = [raw_file.readline() for _ in range(len(gold))]
+            for i in np.nonzero(pred != gold)[0]:
+                g,p = int(gold[i]),int(pred[i])
+                _,neg,question = raw_lines[i].rstrip().split('\t')
                 neg_relations = []
                 for n in neg.split():
                     try:
@@ -259,28 +462,55 @@ def analysis(args,vocab,test_dataset,collate_fn,first_order_fname,second_order_f
                         pass
                 d = dict()
                 d['question'] = question
-                d['gold'] = gold_relation
-                d['gold_type'] = 'seen' if g in args.seen_idx else 'unseen'
+                d['gold'] = vocab.itor[g]
+                d['gold_type'] = relation_type(g)
                 d['pred'] = vocab.itor[p]
-                d['pred_type'] = 'seen' if p in args.seen_idx else 'unseen'
+                d['pred_type'] = relation_type(p)
                 d['negative'] = ' '.join(neg_relations)
-                d['gold_neighbour_seen'] = (adj_matrix[g] * args.label_idx).sum()
-                d['gold_neighbour_unseen'] = (adj_matrix[g] * (1-args.label_idx)).sum()
-                d['gold_total_neighbour'] = adj_matrix[g].sum()
-                d['pred_neighbour_seen'] = (adj_matrix[p] * args.label_idx).sum()
-                d['pred_neighbour_unseen'] = (adj_matrix[p] * (1-args.label_idx)).sum()
-                d['pred_total_neighbour'] = adj_matrix[p].sum()
-                d['rank'] = r
-                d['top_five_relations'] = []
-                for j in k:
-                    t = (vocab.itor[j],'seen' if j in args.seen_idx else 'unseen',adj_matrix[int(j)].sum())
-                    d['top_five_relations'].append(t)
-                outputs.append(d)
-        json.dump(outputs,f,indent=4)
-
-
-if __name__ == '__main__':
-
+                d['gold_neighbour_seen'] = seen_degree[g].item()
+                d['gold_neighbour_unseen'] = unseen_degree[g].item()
+                d['gold_total_neighbour'] = total_degree[g].item()
+                d['pred_neighbour_seen'] = seen_degree[p].item()
+                d['pred_neighbour_unseen'] = unseen_degree[p].item()
+                d['pred_total_neighbour'] = total_degree[p].item()
+                d['rank'] = int(ranks[i])
+                d['top_five_relations'] = [(vocab.itor[j],relation_type(j),total_degree[j].item()) for j in k_preds[i].tolist()]
+                f.write(json.dumps(d) + '\n')
+    pprint(accumulator.summary())
+
+    relations = np.nonzero(accumulator.gold_count)[0]
+    precision = accumulator.per_class()[relations]
+    labels = args.label_idx[relations].astype(int)
+    first_order_seen_density = get_seen_density(adj_matrix,args.seen_idx,args.unseen_idx,order=1)
+    second_order_seen_density = get_seen_density(adj_matrix,args.seen_idx,args.unseen_idx,order=2)
+    plot_relation_density(relations,precision,first_order_seen_density,labels,first_order_fname)
+    plot_relation_density(relations,precision,second_order_seen_density,labels,second_order_fname)
+
+
+def profile_imports(modules=('train_simpleqa','serve_simpleqa'),top=15):
+    # cold-start import cost of each entry module, from `python -X importtime`, aggregated per top-level package
+    for module in modules:
+        output = subprocess.run([sys.executable,'-X','importtime','-c','import {}'.format(module)],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),stderr=subprocess.PIPE,universal_newlines=True).stderr
+        packages = dict()
+        total = 0
+        for line in output.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_us,cumulative_us,name = [field.strip() for field in line[len('import time:'):].split('|')]
+            package = name.split('.')[0]
+            packages[package] = packages.get(package,0) + int(self_us)
+            if name == module:
+                total = int(cumulative_us)
+        print('import {}: {:.2f}s'.format(module,total / 1e6))
+        for package,us in sorted(packages.items(),key=lambda x: -x[1])[:top]:
+            print('    {:<24}{:.3f}s'.format(package,us / 1e6))
+
+
+COMMANDS = ['generate','train','evaluate','visualize','analysis','retrieve','quantize','export','bench_relation','profile_imports']
+
+
+def build_arg_parser():
     args_parser = ArgumentParser()
     args_parser.add_argument('--config_file','-c',default=None,type=str)
     args_parser.add_argument('--generate',action="store_true",default=False,)
@@ -288,20 +518,62 @@ if __name__ == '__main__':
     args_parser.add_argument('--evaluate',action="store_true",default=False)
     args_parser.add_argument('--visualize',action="store_true",default=False)
     args_parser.add_argument('--analysis',action="store_true",default=False)
+    args_parser.add_argument('--retrieve',action="store_true",default=False)
+    args_parser.add_argument('--quantize',action="store_true",default=False)
+    args_parser.add_argument('--bench_relation',action="store_true",default=False)
+    args_parser.add_argument('--export',action="store_true",default=False)
+    args_parser.add_argument('--embedding_dtype',default='bfloat16',choices=['bfloat16','int8'])
+    args_parser.add_argument('--index_type',default='ivf',choices=['exact','ivf'])
+    args_parser.add_argument('--topk',type=int,default=10)
+    args_parser.add_argument('--n_lists',type=int,default=None)
+    args_parser.add_argument('--n_probe',type=int,default=8)
     args_parser.add_argument('--graph_aggr',type=str,default='concat')
     args_parser.add_argument('--self_loop',default=False,)
     args_parser.add_argument('--dataset',default='mix')
     args_parser.add_argument('--norm_type',default='spectral')
+    args_parser.add_argument('--gcn_backend',default='dgl',choices=['dgl','sparse'])
+    args_parser.add_argument('--graph_mode',default='dense',choices=['dense','threshold','knn'])
+    args_parser.add_argument('--block_size',type=int,default=4096)
+    args_parser.add_argument('--knn',type=int,default=10)
+    args_parser.add_argument('--score_all',action="store_true",default=False)
+    args_parser.add_argument('--relation_sampling',action="store_true",default=False)
+    args_parser.add_argument('--rgcn_fanout',type=int,default=0)
+    args_parser.add_argument('--binary_data',action="store_true",default=False)
+    args_parser.add_argument('--embedding_workers',type=int,default=1)
+    args_parser.add_argument('--build_vocab',action="store_true",default=False)
+    args_parser.add_argument('--vocab_workers',type=int,default=1)
+    args_parser.add_argument('--min_freq',type=int,default=1)
+    args_parser.add_argument('--max_vocab_size',type=int,default=None)
+    args_parser.add_argument('--fold_workers',type=int,default=1)
+    args_parser.add_argument('--num_workers',type=int,default=12)
+    args_parser.add_argument('--log_interval',type=int,default=50)
+    args_parser.add_argument('--bucket',action="store_true",default=False)
+    args_parser.add_argument('--negative_sampling',default='uniform',choices=['uniform','frequency','hard'])
+    return args_parser
+
+
+if __name__ == '__main__':
+
+    args_parser = build_arg_parser()
+    # `train_simpleqa.py evaluate -c cfg.yaml` is the same as `train_simpleqa.py --evaluate -c cfg.yaml`
+    args_parser.add_argument('command',nargs='?',default=None,choices=COMMANDS)
     args = parse_args(args_parser)
+    if args.command is not None:
+        setattr(args,args.command,True)
+
+    if args.command == 'profile_imports':
+        profile_imports()
+        sys.exit(0)
     pprint(vars(args))
 
     if args.generate:
         args.data_dir = os.path.join(args.data_dir,'base')
-        # SimpleQADataset.generate_vocab(args)
+        if args.build_vocab:
+            SimpleQADataset.generate_vocab(args)
         # SimpleQADataset.generate_embedding(args,device)
         SimpleQADataset.generate_relation_embedding(args,device)
         SimpleQADataset.generate_graph(args,device)
-    elif args.train or args.evaluate or args.visualize or args.analysis:
+    elif args.train or args.evaluate or args.visualize or args.analysis or args.retrieve or args.quantize or args.export or args.bench_relation:
         if args.visualize or args.analysis:
             args.fold = 10
         main(args)
@@ -1,4 +1,7 @@
 import sys
+import numpy as np
+import scipy.sparse as sp
+
 
 def f1(p,r):
     if r == 0.:
@@ -6,37 +9,64 @@ def f1(p,r):
     return 2 * p * r / float(p + r) * 100
 
 
+def dense_label_ids(list_of_labels):
+    # any hashable labels (ints, type strings, ...) get consecutive column ids in first-seen order
+    label_ids = dict()
+    for labels in list_of_labels:
+        for label in labels:
+            if label not in label_ids:
+                label_ids[label] = len(label_ids)
+    return label_ids
+
+
+def to_indicator(list_of_labels,label_ids):
+    # multi-hot CSR matrix, one row per entity; duplicate labels count once, as with set()
+    lengths = np.array([len(labels) for labels in list_of_labels],dtype=np.int64)
+    rows = np.repeat(np.arange(len(list_of_labels)),lengths)
+    cols = np.fromiter((label_ids[label] for labels in list_of_labels for label in labels),dtype=np.int64,count=lengths.sum())
+    matrix = sp.csr_matrix((np.ones(len(cols)),(rows,cols)),shape=(len(list_of_labels),max(len(label_ids),1)))
+    matrix.data[:] = 1
+    return matrix
+
+
+def label_statistics(true_and_prediction):
+    true_labels = [t for t,_ in true_and_prediction]
+    predicted_labels = [p for _,p in true_and_prediction]
+    label_ids = dense_label_ids(true_labels + predicted_labels)
+    true_matrix = to_indicator(true_labels,label_ids)
+    pred_matrix = to_indicator(predicted_labels,label_ids)
+    # raw list lengths, as the denominators used len(labels); distinct counts for the strict set comparison
+    num_true = np.array([len(labels) for labels in true_labels],dtype=np.float64)
+    num_pred = np.array([len(labels) for labels in predicted_labels],dtype=np.float64)
+    distinct_true = np.asarray(true_matrix.sum(axis=1)).ravel()
+    distinct_pred = np.asarray(pred_matrix.sum(axis=1)).ravel()
+    num_correct = np.asarray(true_matrix.multiply(pred_matrix).sum(axis=1)).ravel()
+    return num_true,num_pred,distinct_true,distinct_pred,num_correct
+
+
 def strict(true_and_prediction):
     num_entities = len(true_and_prediction)
-    correct_num = 0.
-    for true_labels, predicted_labels in true_and_prediction:
-        correct_num += set(true_labels) == set(predicted_labels)
+    _,_,distinct_true,distinct_pred,num_correct = label_statistics(true_and_prediction)
+    correct_num = float(((num_correct == distinct_true) & (num_correct == distinct_pred)).sum())
     precision = recall = correct_num / num_entities
     return precision, recall, f1(precision, recall)
 
 
 def loose_macro(true_and_prediction):
     num_entities = len(true_and_prediction)
-    p = 0.
-    r = 0.
-    for true_labels, predicted_labels in true_and_prediction:
-        if len(predicted_labels) > 0:
-            p += len(set(predicted_labels).intersection(set(true_labels))) / float(len(predicted_labels))
-        if len(true_labels):
-            r += len(set(predicted_labels).intersection(set(true_labels))) / float(len(true_labels))
+    num_true,num_pred,_,_,num_correct = label_statistics(true_and_prediction)
+    p = (num_correct[num_pred > 0] / num_pred[num_pred > 0]).sum()
+    r = (num_correct[num_true > 0] / num_true[num_true > 0]).sum()
     precision = p / num_entities
     recall = r / num_entities
     return precision, recall, f1(precision, recall)
 
 
 def loose_micro(true_and_prediction):
-    num_predicted_labels = 0.
-    num_true_labels = 0.
-    num_correct_labels = 0.
-    for true_labels, predicted_labels in true_and_prediction:
-        num_predicted_labels += len(predicted_labels)
-        num_true_labels += len(true_labels)
-        num_correct_labels += len(set(predicted_labels).intersection(set(true_labels)))
+    num_true,num_pred,_,_,num_correct = label_statistics(true_and_prediction)
+    num_predicted_labels = float(num_pred.sum())
+    num_true_labels = float(num_true.sum())
+    num_correct_labels = float(num_correct.sum())
     precision = num_correct_labels / num_predicted_labels
     recall = num_correct_labels / num_true_labels
     return precision, recall, f1(precision, recall)
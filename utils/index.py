@@ -0,0 +1,119 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+class ExactIndex(object):
+    # brute-force cosine index, scored block by block so the catalog never needs a bsize * N buffer at once
+
+    def __init__(self,vectors,ids=None,block_size=65536):
+        self.vectors = F.normalize(vectors.float(),dim=-1,eps=1e-8)
+        if ids is None:
+            ids = torch.arange(vectors.size(0),device=vectors.device)
+        self.ids = ids
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.vectors.size(0)
+
+    def search(self,queries,k):
+        queries = F.normalize(queries.float(),dim=-1,eps=1e-8)
+        k = min(k,len(self))
+        best_scores,best_idx = None,None
+        for start in range(0,len(self),self.block_size):
+            block = self.vectors[start:start + self.block_size]
+            scores = torch.mm(queries,block.t())
+            block_scores,block_idx = scores.topk(k=min(k,block.size(0)),dim=1)
+            block_idx = block_idx + start
+            if best_scores is None:
+                best_scores,best_idx = block_scores,block_idx
+            else:
+                best_scores,pos = torch.cat([best_scores,block_scores],dim=1).topk(k=k,dim=1)
+                best_idx = torch.cat([best_idx,block_idx],dim=1).gather(1,pos)
+        return best_scores,self.ids[best_idx]
+
+
+class IVFIndex(object):
+    # inverted-file index: vectors are clustered with spherical k-means and a query only scores
+    # the members of its n_probe closest clusters
+
+    def __init__(self,vectors,ids=None,n_lists=None,n_probe=8,n_iter=10,seed=0,block_size=4096):
+        self.vectors = F.normalize(vectors.float(),dim=-1,eps=1e-8)
+        if ids is None:
+            ids = torch.arange(vectors.size(0),device=vectors.device)
+        self.ids = ids
+        if n_lists is None:
+            n_lists = max(1,int(math.sqrt(len(self))))
+        self.n_lists = min(n_lists,len(self))
+        self.n_probe = min(n_probe,self.n_lists)
+        self.block_size = block_size
+        self.centroids = self.train_centroids(n_iter,seed)
+        self.build_lists()
+
+    def __len__(self):
+        return self.vectors.size(0)
+
+    def train_centroids(self,n_iter,seed):
+        generator = torch.Generator().manual_seed(seed)
+        init = torch.randperm(len(self),generator=generator)[:self.n_lists].to(self.vectors.device)
+        centroids = self.vectors[init].clone()
+        for _ in range(n_iter):
+            assign = torch.mm(self.vectors,centroids.t()).argmax(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0,assign,self.vectors)
+            counts = torch.bincount(assign,minlength=self.n_lists)
+            # empty clusters keep their previous centroid
+            nonempty = counts > 0
+            centroids[nonempty] = F.normalize(sums[nonempty],dim=-1,eps=1e-8)
+        return centroids
+
+    def build_lists(self):
+        assign = torch.mm(self.vectors,self.centroids.t()).argmax(dim=1)
+        order = assign.argsort()
+        counts = torch.bincount(assign,minlength=self.n_lists)
+        max_size = int(counts.max())
+        offsets = torch.cumsum(counts,0) - counts
+        # padded list matrix: n_lists * max_size vector positions, -1 where a list is shorter
+        pos_in_list = torch.arange(len(self),device=assign.device) - offsets[assign[order]]
+        self.lists = torch.full((self.n_lists,max_size),-1,dtype=torch.long,device=assign.device)
+        self.lists[assign[order],pos_in_list] = order
+
+    def search(self,queries,k):
+        # probed lists are scored probe by probe in blocks of block_size members and merged into a running
+        # top-k, so peak memory is bsize * block_size * dim however unbalanced the clusters are
+        queries = F.normalize(queries.float(),dim=-1,eps=1e-8)
+        probe = torch.mm(queries,self.centroids.t()).topk(k=self.n_probe,dim=1)[1]  # bsize * n_probe
+        best_scores,best_ids = None,None
+        for j in range(self.n_probe):
+            for start in range(0,self.lists.size(1),self.block_size):
+                candidates = self.lists[probe[:,j],start:start + self.block_size]  # bsize * block
+                valid = candidates >= 0
+                if not valid.any() and best_scores is not None:
+                    # lists are padded at the end, later blocks of this probe are empty too
+                    break
+                candidate_vectors = self.vectors[candidates.clamp(min=0)]
+                scores = torch.bmm(candidate_vectors,queries.unsqueeze(2)).squeeze(2)
+                scores = scores.masked_fill(~valid,-1e9)
+                if best_scores is not None:
+                    scores = torch.cat([best_scores,scores],dim=1)
+                    candidates = torch.cat([best_ids,candidates],dim=1)
+                best_scores,pos = scores.topk(k=min(k,scores.size(1)),dim=1)
+                best_ids = candidates.gather(1,pos)
+        # when the probed lists hold fewer than k members the remaining slots are padding: id -1, score -1e9
+        ids = self.ids[best_ids.clamp(min=0)].masked_fill(best_ids < 0,-1)
+        return best_scores,ids
+
+
+def build_index(vectors,index_type='exact',ids=None,**kwargs):
+    if index_type == 'exact':
+        return ExactIndex(vectors,ids,**kwargs)
+    elif index_type == 'ivf':
+        return IVFIndex(vectors,ids,**kwargs)
+    raise ValueError('Unknown index type: {}'.format(index_type))
+
+
+def recall_at_k(approx_ids,exact_ids,k):
+    # fraction of the exact top-k neighbours that the approximate search also returned
+    approx_ids = approx_ids[:,:k]
+    exact_ids = exact_ids[:,:k]
+    hits = (exact_ids.unsqueeze(2) == approx_ids.unsqueeze(1)).any(dim=2)
+    return hits.float().mean().item()
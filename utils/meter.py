@@ -0,0 +1,62 @@
+import time
+from collections import defaultdict
+
+
+class TrainingMeter(object):
+    # running loss / accuracy are kept as detached device tensors and only read back
+    # every log_interval batches, so the autograd graph of a batch is freed after its step
+
+    def __init__(self,total_batch,log_interval=50):
+        self.total_batch = total_batch
+        self.log_interval = log_interval
+        self.loss_sum = 0.
+        self.correct = 0
+        self.total = 0
+        self.n_batch = 0
+        self.times = defaultdict(float)
+        self.start_time = time.time()
+
+    def add_time(self,phase,seconds):
+        # host-side wall time; on GPU, kernels still running are attributed to the next phase that waits on them
+        self.times[phase] += seconds
+
+    def update(self,loss,correct,bsize):
+        self.loss_sum = self.loss_sum + loss.detach() * bsize
+        self.correct = self.correct + correct.detach()
+        self.total += bsize
+        self.n_batch += 1
+        if self.log_interval > 0 and (self.n_batch % self.log_interval == 0 or self.n_batch == self.total_batch):
+            self.report()
+
+    def loss(self):
+        return float(self.loss_sum) / max(self.total,1)
+
+    def accuracy(self):
+        return float(self.correct) / max(self.total,1)
+
+    def report(self):
+        print('\r Batch {}/{}, Training Loss:{:.4f}, Training Acc:{:.2f}'.format(self.n_batch,self.total_batch,self.loss(),self.accuracy()*100),end='')
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        return {
+            'loss':self.loss(),
+            'acc':self.accuracy(),
+            'examples':self.total,
+            'examples_per_sec':self.total / elapsed if elapsed > 0 else 0.,
+            'time':elapsed,
+            'data_time':self.times['data'],
+            'forward_time':self.times['forward'],
+            'backward_time':self.times['backward'],
+        }
+
+    def log_summary(self,epoch,logfile=None):
+        summary = self.summary()
+        line = ' Epoch {} Train Loss:{:.4f}, Acc:{:.2f}, {:.1f} examples/s, time {:.1f}s (data {:.1f}s, forward {:.1f}s, backward {:.1f}s)'.format(
+            epoch,summary['loss'],summary['acc']*100,summary['examples_per_sec'],summary['time'],
+            summary['data_time'],summary['forward_time'],summary['backward_time'])
+        print('\n' + line)
+        if logfile is not None:
+            print(line,file=logfile)
+            logfile.flush()
+        return summary
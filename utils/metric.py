@@ -1,27 +1,112 @@
-from collections import defaultdict
+import numpy as np
+
+
+def to_numpy(x):
+    if hasattr(x,'detach'):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x)
 
 
 def micro_precision(pred,gold):
-    correct = 0
-    for p,g in zip(pred,gold):
-        if p == g:
-            correct += 1
-    return correct * 1.0 / len(gold)
+    pred,gold = to_numpy(pred),to_numpy(gold)
+    return float((pred == gold).mean())
 
 
 def each_precision(pred,gold):
-    gold_relation_length = defaultdict(lambda:0)
-    tp = defaultdict(lambda:0)
-    for p,g in zip(pred,gold):
-        gold_relation_length[g] += 1
-        if p == g:
-            tp[g] += 1
-    each_precision = []
-    for g in gold_relation_length:
-        each_precision.append(tp[g]*1.0/gold_relation_length[g])
-    return each_precision
+    pred,gold = to_numpy(pred).astype(np.int64),to_numpy(gold).astype(np.int64)
+    gold_relation_length = np.bincount(gold)
+    tp = np.bincount(gold[pred == gold],minlength=len(gold_relation_length))
+    present = gold_relation_length > 0
+    return (tp[present] / gold_relation_length[present]).tolist()
 
 
 def macro_precision(pred,gold):
     precision = each_precision(pred,gold)
     return sum(precision)/len(precision)
+
+
+def mean_rank(ranks):
+    return float(to_numpy(ranks).mean())
+
+
+def mrr(ranks):
+    return float((1.0 / to_numpy(ranks)).mean())
+
+
+def hits_at_k(ranks,k):
+    return float((to_numpy(ranks) <= k).mean())
+
+
+def topk_accuracy(k_preds,gold,k):
+    # fraction of examples whose gold relation is among the first k predictions
+    k_preds,gold = to_numpy(k_preds),to_numpy(gold)
+    return float((k_preds[:,:k] == gold.reshape(-1,1)).any(axis=1).mean())
+
+
+class MetricAccumulator(object):
+    # streaming precision / ranking metrics: batches are folded into per-class bincounts and running sums,
+    # so predictions never have to be collected into lists
+
+    def __init__(self,n_classes,ks=(1,5,10)):
+        self.n_classes = n_classes
+        self.ks = ks
+        self.gold_count = np.zeros(n_classes,dtype=np.int64)
+        self.hit_count = np.zeros(n_classes,dtype=np.int64)
+        self.total = 0
+        self.correct = 0
+        self.n_ranked = 0
+        self.rank_sum = 0.
+        self.reciprocal_rank_sum = 0.
+        self.hits = dict((k,0) for k in ks)
+
+    def update(self,pred,gold,ranks=None):
+        pred,gold = to_numpy(pred).astype(np.int64),to_numpy(gold).astype(np.int64)
+        correct = pred == gold
+        self.gold_count += np.bincount(gold,minlength=self.n_classes)
+        self.hit_count += np.bincount(gold[correct],minlength=self.n_classes)
+        self.total += len(gold)
+        self.correct += int(correct.sum())
+        if ranks is not None:
+            ranks = to_numpy(ranks).astype(np.float64)
+            self.n_ranked += len(ranks)
+            self.rank_sum += ranks.sum()
+            self.reciprocal_rank_sum += (1.0 / ranks).sum()
+            for k in self.ks:
+                self.hits[k] += int((ranks <= k).sum())
+
+    def micro(self):
+        return self.correct / self.total if self.total else 0.
+
+    def per_class(self):
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return self.hit_count / self.gold_count
+
+    def macro(self):
+        present = self.gold_count > 0
+        return float((self.hit_count[present] / self.gold_count[present]).mean()) if present.any() else 0.
+
+    def summary(self):
+        summary = {'micro':self.micro(),'macro':self.macro()}
+        if self.n_ranked:
+            summary['mrr'] = self.reciprocal_rank_sum / self.n_ranked
+            summary['mean_rank'] = self.rank_sum / self.n_ranked
+            for k in self.ks:
+                summary['hits@{}'.format(k)] = self.hits[k] / self.n_ranked
+        return summary
+
+
+def precision_breakdown(pred,gold,seen_mask,n_classes):
+    # micro / macro precision over all, seen-gold and unseen-gold examples plus per-relation precision,
+    # all from one pass over the predictions
+    pred = to_numpy(pred).astype(np.int64)
+    gold = to_numpy(gold).astype(np.int64)
+    seen = to_numpy(seen_mask)[gold].astype(bool)
+    breakdown = dict()
+    for name,mask in [('all',np.ones(len(gold),dtype=bool)),('seen',seen),('unseen',~seen)]:
+        accumulator = MetricAccumulator(n_classes)
+        accumulator.update(pred[mask],gold[mask])
+        breakdown[name] = (float(accumulator.micro()),accumulator.macro())
+        if name == 'all':
+            breakdown['per_relation'] = accumulator.per_class()
+            breakdown['relation_count'] = accumulator.gold_count
+    return breakdown
@@ -37,6 +37,14 @@ class LSTMEncoder(nn.Module):
             outputs = outputs[unperm_idx]
         return outputs,ht.permute(1,0,2).contiguous().view(bsize,-1)
 
+    def forward_packed(self,inputs,unperm_idx=None):
+        # inputs: a PackedSequence built from length-sorted rows, unperm_idx restores the original row order
+        outputs,_ = self.rnn(inputs)
+        outputs,_ = unpack(outputs,batch_first=True)
+        if unperm_idx is not None:
+            outputs = outputs[unperm_idx]
+        return outputs
+
 
 def mean_pool(input,length):
     # input: bsize *  seq_len * dim
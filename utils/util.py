@@ -1,6 +1,11 @@
+import io
+import os
+import json
+import hashlib
 import numpy as np
 import torch
 import yaml
+from concurrent.futures import ProcessPoolExecutor
 
 
 def pad(data,pad_idx,max_len=None):
@@ -9,6 +14,17 @@ def pad(data,pad_idx,max_len=None):
     return [instance + [pad_idx]*max((max_len-len(instance),0)) for instance in data]
 
 
+def pad_array(data,pad_idx,max_len=None,dtype=np.int64):
+    # same as pad, but fills a preallocated array and accepts lists or numpy slices
+    if max_len is None:
+        max_len = max([len(instance) for instance in data])
+    out = np.full((len(data),max_len),pad_idx,dtype=dtype)
+    for i,instance in enumerate(data):
+        length = min(len(instance),max_len)
+        out[i,:length] = instance[:length]
+    return out
+
+
 def one_hot_to_labels(tensor,one_label=None):
     # tensor bsize * N_C
     bsize,_ = tensor.size()
@@ -24,24 +40,102 @@ def one_hot_to_labels(tensor,one_label=None):
     return labels
 
 
-def load_pretrained(filepath,vocab,dim,device,pad_idx):
-
-    vecs = np.random.normal(0,1,(len(vocab),dim))
-    vecs[pad_idx] = np.zeros((dim))
-    cnt = 0
-    with open(filepath,'r') as f:
-        f.readline()
-        for line in f:
-            splited = line.split(' ')
-            word = splited[0]
-            if word not in vocab:
-                continue
-            cnt += 1
-            vec = [float(f) for f in splited[1:]]
-            vecs[vocab[word]] = vec
-        print('Found word vectors: {}/{}'.format(cnt,len(vocab)))
-    tensor = torch.from_numpy(vecs)
-    return tensor.float().to(device)
+def file_fingerprint(filepath,head_bytes=1 << 20):
+    # size, mtime and the first MB identify a multi-GB vector file without hashing all of it
+    stat = os.stat(filepath)
+    h = hashlib.sha1('{}:{}:{}'.format(os.path.abspath(filepath),stat.st_size,stat.st_mtime_ns).encode())
+    with open(filepath,'rb') as f:
+        h.update(f.read(head_bytes))
+    return h.hexdigest()
+
+
+def vocab_fingerprint(vocab):
+    h = hashlib.sha1()
+    for word,idx in sorted(vocab.items(),key=lambda x: x[1]):
+        h.update('{}\t{}\n'.format(word,idx).encode())
+    return h.hexdigest()
+
+
+def chunk_offsets(filepath,n_chunks,skip_header=False):
+    # byte ranges that start and end on line boundaries
+    size = os.path.getsize(filepath)
+    with open(filepath,'rb') as f:
+        start = len(f.readline()) if skip_header else 0
+        offsets = [start]
+        for i in range(1,n_chunks):
+            f.seek(max(start + (size - start) * i // n_chunks,offsets[-1]))
+            f.readline()
+            offsets.append(min(f.tell(),size))
+        offsets.append(size)
+    return sorted(set(offsets))
+
+
+def parse_vector_chunk(filepath,start,end,vocab,dim,sep):
+    with open(filepath,'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).decode('utf-8')
+    # split at \n / \r\n / \r only, as text-mode iteration does; str.splitlines would also cut a token
+    # containing \x85 or \u2028 in two and attach its vector to the wrong word
+    words,values = [],[]
+    for line in io.StringIO(data,newline=None):
+        splited = line.rstrip('\n').split(sep,1)
+        if len(splited) < 2 or splited[0] not in vocab:
+            continue
+        words.append(splited[0])
+        values.append(splited[1])
+    vecs = np.fromstring(' '.join(values),dtype=np.float32,sep=' ')
+    if vecs.size != len(words) * dim:
+        # some line has a different width; drop the malformed ones
+        keep = [i for i,v in enumerate(values) if len(v.split()) == dim]
+        words = [words[i] for i in keep]
+        vecs = np.fromstring(' '.join(values[i] for i in keep),dtype=np.float32,sep=' ')
+    return words,vecs.reshape(-1,dim)
+
+
+def read_pretrained(filepath,vocab,dim,sep=' ',skip_header=True,workers=1):
+    # one pass over the text file, keeping only vocab words; rows are float32 and zero where not found
+    offsets = chunk_offsets(filepath,max(workers,1) * 4,skip_header)
+    ranges = list(zip(offsets[:-1],offsets[1:]))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(parse_vector_chunk,*zip(*[(filepath,s,e,vocab,dim,sep) for s,e in ranges])))
+    else:
+        chunks = [parse_vector_chunk(filepath,s,e,vocab,dim,sep) for s,e in ranges]
+    vecs = np.zeros((len(vocab),dim),dtype=np.float32)
+    found = np.zeros(len(vocab),dtype=bool)
+    for words,chunk_vecs in chunks:
+        idxs = np.array([vocab[w] for w in words],dtype=np.int64)
+        vecs[idxs] = chunk_vecs
+        found[idxs] = True
+    return vecs,found
+
+
+def load_pretrained(filepath,vocab,dim,device,pad_idx,sep=' ',skip_header=True,cache_dir=None,workers=1):
+    # parsed vectors are cached as .npy keyed on the source file and the vocab, later runs mmap them back
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)),'.embedding_cache')
+    key = hashlib.sha1('{}:{}:{}'.format(file_fingerprint(filepath),vocab_fingerprint(vocab),dim).encode()).hexdigest()
+    vecs_pth = os.path.join(cache_dir,key + '.npy')
+    found_pth = os.path.join(cache_dir,key + '.found.npy')
+    if os.path.exists(vecs_pth) and os.path.exists(found_pth):
+        vecs = np.load(vecs_pth,mmap_mode='r')
+        found = np.load(found_pth)
+    else:
+        vecs,found = read_pretrained(filepath,vocab,dim,sep,skip_header,workers)
+        os.makedirs(cache_dir,exist_ok=True)
+        np.save(vecs_pth,vecs)
+        np.save(found_pth,found)
+        itos = dict((idx,word) for word,idx in vocab.items())
+        with open(os.path.join(cache_dir,key + '.words.json'),'w') as f:
+            json.dump({'source':os.path.abspath(filepath),'found':[itos[i] for i in np.nonzero(found)[0].tolist()]},f)
+    print('Found word vectors: {}/{}'.format(int(found.sum()),len(vocab)))
+
+    # words without a pretrained vector keep a random N(0,1) initialization, drawn from the global numpy seed
+    rng = np.random.default_rng(np.random.randint(2**31))
+    out = rng.standard_normal((len(vocab),dim),dtype=np.float32)
+    out[found] = vecs[found]
+    out[pad_idx] = 0
+    return torch.from_numpy(out).to(device)
 
 
 def pairwise_distances(x, y=None):
@@ -52,16 +52,16 @@ def plot_density(pred,gold,density,seen_idxs,fname):
         gold_relation_length[g] += 1
         if p == g:
             tp[g] += 1
-    x = []
-    y = []
-    labels = []
-    for g in gold_relation_length:
-        x.append(density[g])
-        y.append(tp[g]*1./gold_relation_length[g])
-        labels.append(1 if g in seen_idxs else 0)
+    relations = list(gold_relation_length)
+    precision = [tp[g]*1./gold_relation_length[g] for g in relations]
+    seen_idxs = set(seen_idxs)
+    plot_relation_density(relations,precision,density,[1 if g in seen_idxs else 0 for g in relations],fname)
+
+
+def plot_relation_density(relations,precision,density,labels,fname):
     df = pd.DataFrame()
-    df['density of seen nodes in neighbours'] = x
-    df['precision'] = y
+    df['density of seen nodes in neighbours'] = np.asarray(density)[np.asarray(relations)]
+    df['precision'] = precision
     df['Seen or Unseen'] = labels
     sns.scatterplot(x='density of seen nodes in neighbours',y='precision',data=df,hue='Seen or Unseen',s=10)
     plt.savefig(fname)